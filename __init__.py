@@ -8,7 +8,7 @@ from wizard import (
     UpdateMagentoCatalogStart, UpdateMagentoCatalog,
     SuccessStart, ExportDataWizardConfigure, ExportDataWizard,
 )
-from channel import Channel, MagentoTier
+from channel import Channel, MagentoTier, ChannelException
 from party import Party, MagentoWebsiteParty, Address
 from product import (
     Category, MagentoInstanceCategory, Product,
@@ -23,6 +23,7 @@ from sale import (
 from bom import BOM
 from tax import MagentoTax, MagentoTaxRelation
 from payment import MagentoPaymentGateway, Payment
+from stock import InventoryQueue, Move
 
 
 def register():
@@ -32,6 +33,7 @@ def register():
     Pool.register(
         Channel,
         MagentoTier,
+        ChannelException,
         MagentoInstanceCarrier,
         TestMagentoConnectionStart,
         ImportStoresStart,
@@ -61,6 +63,8 @@ def register():
         ProductSaleChannelListing,
         MagentoPaymentGateway,
         Payment,
+        InventoryQueue,
+        Move,
         module='magento', type_='model'
     )
     Pool.register(
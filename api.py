@@ -1,6 +1,242 @@
 # -*- coding: utf-8 -*-
+import time
+import socket
+import threading
+import xmlrpclib
+
+import magento
 from magento.api import API
 
+#: Fault code sent by magento when the session used for a call has expired
+SESSION_EXPIRED_FAULT = 5
+
+#: Fault code sent by magento for a product which does not exist
+PRODUCT_NOT_EXISTS_FAULT = 101
+
+_local = threading.local()
+
+
+class TimeoutTransport(xmlrpclib.Transport):
+    """
+    XML-RPC transport whose connections give up on a server which does not
+    answer within the timeout, raising `socket.timeout`
+    """
+
+    def __init__(self, timeout, use_datetime=0):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = xmlrpclib.Transport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class SafeTimeoutTransport(xmlrpclib.SafeTransport):
+    """
+    HTTPS version of `TimeoutTransport`
+    """
+
+    def __init__(self, timeout, use_datetime=0):
+        xmlrpclib.SafeTransport.__init__(self, use_datetime)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = xmlrpclib.SafeTransport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+
+
+def get_timeout_transport(url, timeout):
+    """
+    Returns the transport for the URL applying the timeout, None to use
+    the default transport when there is no timeout
+
+    :param url: URL of the magento instance
+    :param timeout: Timeout of the calls in seconds
+    """
+    if not timeout:
+        return None
+    if url.lower().startswith('https'):
+        return SafeTimeoutTransport(timeout)
+    return TimeoutTransport(timeout)
+
+
+def get_active_sessions():
+    """
+    Returns the session managers of the sync runs active in this thread,
+    keyed by the ID of the channel they belong to
+    """
+    if not hasattr(_local, 'sessions'):
+        _local.sessions = {}
+    return _local.sessions
+
+
+class SessionManager(object):
+    """
+    Manages a single magento API session for the length of a channel sync
+    run.
+
+    Resource proxies handed out by the manager share the session of the
+    first resource which logged in, so a run costs one `login` and one
+    `endSession` however many records it touches. When magento reports the
+    session as expired, the manager logs in again and the failed call is
+    retried.
+
+    The manager also holds the memos of the lookups made during the run,
+    which outlive the commits of the run and are dropped with it.
+    """
+
+    def __init__(self, url, username, password, timeout=None):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.client = None
+        self.session = None
+        self.resources = {}
+        self.entered = []
+        self.memos = {}
+
+    def get(self, resource):
+        """
+        Returns a proxy to the API of the given resource, creating the API
+        on first use
+
+        :param resource: Name of the API class in the magento library
+                         (e.g. 'Order') or a subclass of magento API
+        :return: `SessionProxy` for the resource API
+        """
+        if resource not in self.resources:
+            Klass = resource
+            if isinstance(resource, basestring):
+                Klass = getattr(magento, resource)
+            api = Klass(
+                self.url, self.username, self.password,
+                transport=get_timeout_transport(self.url, self.timeout)
+            )
+
+            if self.session is None:
+                # Nobody logged in yet, this API opens the session
+                api = api.__enter__()
+                self.entered.append(api)
+                self.client = getattr(api, 'client', None)
+                self.session = getattr(api, 'session', None)
+            else:
+                api.client = self.client
+                api.session = self.session
+            self.resources[resource] = api
+
+        return SessionProxy(self, self.resources[resource])
+
+    def relogin(self):
+        """
+        Logs in again and hands the new session to every resource API
+        """
+        self.session = self.client.login(self.username, self.password)
+        for api in self.resources.itervalues():
+            api.session = self.session
+
+    def close(self):
+        """
+        Ends the session(s) opened by this manager
+        """
+        for api in self.entered:
+            api.__exit__(None, None, None)
+        self.entered = []
+        self.resources = {}
+        self.client = None
+        self.session = None
+
+
+class SessionProxy(object):
+    """
+    Wraps a resource API so that a call failing because of an expired
+    session is retried once after logging in again.
+    """
+
+    def __init__(self, manager, api):
+        self._manager = manager
+        self._api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                return attr(*args, **kwargs)
+            except xmlrpclib.Fault, fault:
+                if fault.faultCode != SESSION_EXPIRED_FAULT or \
+                        self._manager.client is None:
+                    raise
+            self._manager.relogin()
+            return attr(*args, **kwargs)
+        return call
+
+
+class AdaptiveBatcher(object):
+    """
+    Splits items into batches for bulk calls to magento, tuning the size of
+    the batches to the server as it goes.
+
+    The size grows while the calls come back within the target time and
+    shrinks in proportion when they take longer. A batch which times out
+    or fails with a server error (HTTP 5xx) is sent again at half the size,
+    until the minimum size is reached. The calls must be safe to repeat.
+    """
+
+    #: Factor by which the size grows after a quick call
+    growth = 1.5
+
+    def __init__(self, size, target_time, min_size=1, max_size=1000):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = max(min(size or min_size, max_size), min_size)
+        self.target_time = target_time
+
+    def run(self, items, call):
+        """
+        Calls the function with each batch of the items
+
+        :param items: List of items
+        :param call: Function called with a list of items
+        :return: Iterator of tuples of the batch and the result of the call
+        """
+        index = 0
+        while index < len(items):
+            items_batch = items[index:index + self.size]
+            started = time.time()
+            try:
+                result = call(items_batch)
+            except (socket.timeout, xmlrpclib.ProtocolError), exc:
+                if isinstance(exc, xmlrpclib.ProtocolError) and \
+                        exc.errcode < 500:
+                    raise
+                if self.size <= self.min_size:
+                    raise
+                self.size = max(self.size // 2, self.min_size)
+                continue
+            self.tune(time.time() - started, len(items_batch))
+            index += len(items_batch)
+            yield items_batch, result
+
+    def tune(self, elapsed, count):
+        """
+        Adjusts the size after a call on count items took elapsed seconds
+        """
+        if not self.target_time:
+            return
+        if elapsed <= self.target_time:
+            if count < self.size:
+                # A short last batch says nothing about larger ones
+                return
+            size = max(int(self.size * self.growth), self.size + 1)
+        else:
+            size = int(count * self.target_time / elapsed)
+        self.size = max(min(size, self.max_size), self.min_size)
+
 
 class Core(API):
     """
@@ -1,18 +1,34 @@
 # -*- coding: utf-8 -*-
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import defaultdict
+from contextlib import contextmanager
+import uuid
+import multiprocessing
 import magento
 import logging
 import xmlrpclib
 import socket
 
+from sql import Column
+try:
+    from sql import Null
+except ImportError:
+    Null = None
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
 from trytond.model import ModelView, ModelSQL, fields
-from .api import OrderConfig
+from trytond.tools import grouped_slice
+from .api import (
+    OrderConfig, SessionManager, get_active_sessions, PRODUCT_NOT_EXISTS_FAULT
+)
+from .scheduler import (
+    run_channel_jobs, run_product_import_workers, init_worker_process,
+    new_import_report, merge_import_reports
+)
 
 __metaclass__ = PoolMeta
-__all__ = ['Channel', 'MagentoTier']
+__all__ = ['Channel', 'MagentoTier', 'ChannelException']
 
 MAGENTO_STATES = {
     'invisible': ~(Eval('source') == 'magento'),
@@ -25,6 +41,9 @@ INVISIBLE_IF_NOT_MAGENTO = {
 
 logger = logging.getLogger('magento')
 
+#: Format of the dates and times sent and accepted by magento (UTC)
+MAGENTO_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
 
 def batch(iterable, n=1):
     l = len(iterable)
@@ -106,6 +125,121 @@ class Channel:
     magento_payment_gateways = fields.One2Many(
         'magento.instance.payment_gateway', 'channel', 'Payments',
     )
+    magento_order_batch_size = fields.Integer(
+        'Order Batch Size', help='Number of orders fetched from magento in '
+        'a single multicall while importing orders',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_order_commit_size = fields.Integer(
+        'Order Commit Size', help='Number of orders committed together '
+        'while importing orders',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_order_import_overlap = fields.Integer(
+        'Order Import Overlap (Minutes)', help='Orders updated on magento '
+        'up to these many minutes before the last order import time are '
+        'listed again while importing orders. This catches orders which '
+        'were saved late on magento.',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_host_concurrency = fields.Integer(
+        'Host Concurrency', help='Maximum number of channels on the same '
+        'magento host which are synchronised at once by the scheduled jobs',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_sync_timeout = fields.Integer(
+        'Sync Timeout (Seconds)', help='Scheduled jobs of this channel '
+        'running longer than this are abandoned and rolled back. Leave '
+        'empty to never time out.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_call_timeout = fields.Integer(
+        'Call Timeout (Seconds)', help='Calls to magento which get no '
+        'answer within this time fail. A batch of inventory which times out '
+        'is sent again at half the size. Leave empty to wait for the '
+        'answers however long they take.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+
+    #: Checkpoint of the order import run in progress. It is cleared when
+    #: the run completes, a run which failed is resumed from here.
+    magento_order_import_run = fields.Char(
+        'Order Import Run', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_order_import_page = fields.Integer(
+        'Order Import Last Page', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_order_import_increment_id = fields.Char(
+        'Order Import Last Increment ID', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_order_import_updated_at = fields.DateTime(
+        'Order Import Last Updated At', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+
+    magento_product_import_chunk_size = fields.Integer(
+        'Product Import Chunk Size', help='Products are listed from magento '
+        'in ranges of these many product IDs while importing products',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_product_import_workers = fields.Integer(
+        'Product Import Workers', help='Number of worker processes which '
+        'import products in parallel, each in a transaction and a magento '
+        'session of its own',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_product_import_overlap = fields.Integer(
+        'Product Import Overlap (Minutes)', help='Products updated on '
+        'magento up to these many minutes before the last product import '
+        'time are listed again while importing products. This covers a '
+        'difference between the clocks of tryton and magento.',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    last_product_import_time = fields.DateTime(
+        'Last Product Import Time', help='Only the products created or '
+        'updated on magento since this time are listed while importing '
+        'products. Leave empty to import the whole catalog.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    #: Checkpoint of the product import run in progress. It is cleared when
+    #: the run completes, a run which failed is resumed from here.
+    magento_product_import_last_id = fields.Integer(
+        'Product Import Last ID', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+
+    magento_inventory_batch_size = fields.Integer(
+        'Inventory Batch Size', help='Number of products whose inventory '
+        'is sent to magento in a single call, until the inventory export '
+        'has tuned it: the batches grow while the calls are quicker than '
+        'the target time and shrink when they are slower or fail on the '
+        'server.',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    #: Batch size tuned by the inventory exports, reset when the batch size
+    #: is changed
+    magento_inventory_tuned_batch_size = fields.Integer(
+        'Tuned Inventory Batch Size', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_inventory_batch_time = fields.Float(
+        'Inventory Batch Target Time (Seconds)', help='Round trip time '
+        'aimed at by the inventory export when tuning the batch size',
+        states=MAGENTO_STATES, depends=['source']
+    )
+
+    #: Synchronisation settings required on magento channels, filled with
+    #: their defaults on the channels created before they existed
+    _magento_sync_defaults = [
+        'magento_order_batch_size', 'magento_order_commit_size',
+        'magento_order_import_overlap', 'magento_host_concurrency',
+        'magento_product_import_chunk_size', 'magento_product_import_workers',
+        'magento_product_import_overlap', 'magento_inventory_batch_size',
+        'magento_inventory_batch_time',
+    ]
 
     @classmethod
     def __setup__(cls):
@@ -137,6 +271,22 @@ class Channel:
             }
         })
 
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        super(Channel, cls).__register__(module_name)
+
+        # Migration: the synchronisation settings are required on magento
+        # channels, fill them with their defaults on existing channels
+        for field_name in cls._magento_sync_defaults:
+            column = Column(table, field_name)
+            cursor.execute(*table.update(
+                [column], [getattr(cls, 'default_%s' % field_name)()],
+                where=column == Null
+            ))
+
     def validate_magento_channel(self):
         """
         Make sure channel source is magento
@@ -160,6 +310,83 @@ class Channel:
         """
         return 'mag_'
 
+    @staticmethod
+    def default_magento_order_batch_size():
+        """
+        Sets default number of orders fetched in a single multicall
+        """
+        return 50
+
+    @staticmethod
+    def default_magento_order_commit_size():
+        """
+        Sets default number of orders committed together
+        """
+        return 100
+
+    @staticmethod
+    def default_magento_order_import_overlap():
+        """
+        Sets default overlap window of order imports
+        """
+        return 10
+
+    @staticmethod
+    def default_magento_product_import_overlap():
+        """
+        Sets default overlap window of product imports
+        """
+        return 10
+
+    @staticmethod
+    def default_magento_product_import_chunk_size():
+        """
+        Sets default range of product IDs listed at once
+        """
+        return 500
+
+    @staticmethod
+    def default_magento_product_import_workers():
+        """
+        Sets default number of product import workers
+        """
+        return 1
+
+    @staticmethod
+    def default_magento_inventory_batch_size():
+        """
+        Sets default number of products in an inventory export call
+        """
+        return 50
+
+    @staticmethod
+    def default_magento_inventory_batch_time():
+        """
+        Sets default target time of an inventory export call
+        """
+        return 5.0
+
+    @staticmethod
+    def default_magento_host_concurrency():
+        """
+        Sets default number of channels of a host synchronised at once
+        """
+        return 2
+
+    @staticmethod
+    def default_magento_sync_timeout():
+        """
+        Sets default timeout of the scheduled jobs of a channel
+        """
+        return 1800
+
+    @staticmethod
+    def default_magento_call_timeout():
+        """
+        Sets default timeout of the calls to magento
+        """
+        return 60
+
     @staticmethod
     def default_magento_root_category_id():
         """
@@ -168,12 +395,63 @@ class Channel:
         """
         return 1
 
+    @classmethod
+    def write(cls, *args):
+        """
+        Resets the tuned inventory batch size of the channels whose batch
+        size is changed
+        """
+        actions = iter(args)
+        args = []
+        for channels, values in zip(actions, actions):
+            if 'magento_inventory_batch_size' in values:
+                values = values.copy()
+                values.setdefault('magento_inventory_tuned_batch_size', None)
+            args.extend((channels, values))
+        super(Channel, cls).write(*args)
+
+    @contextmanager
+    def magento_sync(self):
+        """
+        Scope a sync run of this channel. Every `magento_session` opened for
+        this channel inside the block shares one login, which is closed when
+        the block ends. Nested runs reuse the outermost one.
+
+        :return: The `SessionManager` of the run
+        """
+        sessions = get_active_sessions()
+        if self.id in sessions:
+            yield sessions[self.id]
+            return
+
+        manager = sessions[self.id] = SessionManager(
+            self.magento_url, self.magento_api_user, self.magento_api_key,
+            timeout=self.magento_call_timeout
+        )
+        try:
+            yield manager
+        finally:
+            del sessions[self.id]
+            manager.close()
+
+    @contextmanager
+    def magento_session(self, resource):
+        """
+        Yield the API for the given magento resource. Within a sync run the
+        session of the run is reused, else a session is opened for the block
+        alone.
+
+        :param resource: Name of the API in the magento library (e.g.
+                         'Order') or a subclass of magento API
+        """
+        with self.magento_sync() as manager:
+            yield manager.get(resource)
+
     def get_taxes(self, rate):
         "Return list of tax records with the given rate"
-        for mag_tax in self.magento_taxes:
-            if mag_tax.tax_percent == rate:
-                return list(mag_tax.taxes)
-        return []
+        MagentoTax = Pool().get('sale.channel.magento.tax')
+
+        return MagentoTax.get_taxes_for_rate(self, rate)
 
     def import_order_states(self):
         """
@@ -186,10 +464,7 @@ class Channel:
 
         with Transaction().set_context({'current_channel': self.id}):
             # Import order states
-            with OrderConfig(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as order_config_api:
+            with self.magento_session(OrderConfig) as order_config_api:
                 order_states_data = order_config_api.get_states()
                 for code, name in order_states_data.iteritems():
                     self.create_order_state(code, name)
@@ -236,9 +511,8 @@ class Channel:
         for channel in channels:
             channel.validate_magento_channel()
             with Transaction().set_context({'current_channel': channel.id}):
-                with OrderConfig(
-                    channel.magento_url, channel.magento_api_user,
-                    channel.magento_api_key
+                with channel.magento_session(
+                    OrderConfig
                 ) as order_config_api:
                     mag_carriers = order_config_api.get_shipping_methods()
 
@@ -264,21 +538,172 @@ class Channel:
         if self.source != 'magento':
             return super(Channel, self).import_products()
 
-        self.import_category_tree()
+        Product = Pool().get('product.product')
 
-        with Transaction().set_context({'current_channel': self.id}):
-            with magento.Product(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as product_api:
-                # TODO: Implement pagination and import each product as async
-                # task
-                magento_products = product_api.list()
+        if self.magento_product_import_last_id:
+            # The previous run did not complete, resume it after the last
+            # range it committed
+            logger.info(
+                "Resuming product import of channel %s after product %s" % (
+                    self.id, self.magento_product_import_last_id
+                )
+            )
+
+        started_at = datetime.utcnow()
+        report = new_import_report()
+        workers = max(self.magento_product_import_workers or 1, 1)
+        pool = None
+        with self.magento_sync():
+            self.import_category_tree()
+
+            if workers > 1:
+                # Workers see only what is committed
+                Transaction().cursor.commit()
+                pool = multiprocessing.Pool(
+                    workers, initializer=init_worker_process
+                )
 
-                products = []
-                for magento_product in magento_products:
-                    products.append(self.import_product(magento_product['sku']))
+            with Transaction().set_context({'current_channel': self.id}):
+                with self.magento_session('Product') as product_api:
+                    if self.last_product_import_time:
+                        # Only the products created or updated since the
+                        # last import, existing ones are updated. The last
+                        # import time is taken from the clock of tryton,
+                        # the overlap makes up for the one of magento.
+                        chunks = self.get_magento_updated_product_chunks(
+                            product_api,
+                            self.last_product_import_time - timedelta(
+                                minutes=(
+                                    self.magento_product_import_overlap or 0
+                                )
+                            )
+                        )
+                    else:
+                        chunks = self.get_magento_product_chunks(
+                            product_api,
+                            self.magento_product_import_last_id or 0
+                        )
+                    update = bool(self.last_product_import_time)
+                    try:
+                        for last_id, magento_products in chunks:
+                            merge_import_reports(
+                                report, self.import_products_using_skus([
+                                    magento_product['sku']
+                                    for magento_product in magento_products
+                                ], update=update, pool=pool, workers=workers)
+                            )
+
+                            # Persist the products of this chunk along with
+                            # the checkpoint before listing the next one
+                            if last_id:
+                                self.write([self], {
+                                    'magento_product_import_last_id': last_id,
+                                })
+                            Transaction().cursor.commit()
+                    finally:
+                        if pool is not None:
+                            pool.close()
+                            pool.join()
+
+            self.write([self], {
+                'magento_product_import_last_id': None,
+                'last_product_import_time': started_at,
+            })
+
+        logger.info(
+            "Product import of channel %s: %s products imported, %s SKUs "
+            "missing on magento, %s shards failed" % (
+                self.id, len(report['product_ids']),
+                len(report['missing_skus']), len(report['failures'])
+            )
+        )
+        for skus, error in report['failures']:
+            logger.error(
+                "Products %s of channel %s could not be imported:\n%s" % (
+                    ', '.join(skus), self.id, error
+                )
+            )
+        return Product.browse(report['product_ids'])
 
-        return products
+    def import_products_using_skus(
+        self, skus, update=False, pool=None, workers=1
+    ):
+        """
+        Import the products of the SKUs, in the worker processes of the pool
+        when there is one, else in the current transaction
+
+        :param skus: List of SKUs
+        :param update: If True, existing products are updated
+        :param pool: `multiprocessing.Pool` of product import workers
+        :param workers: Number of processes of the pool
+        :return: Report of the import, see `run_product_import_workers`
+        """
+        if pool is not None:
+            return run_product_import_workers(
+                pool, workers, self, skus, update=update
+            )
+
+        report = new_import_report()
+        products = self.get_products_by_skus(skus, update=update)
+        report['product_ids'] = map(int, products.values())
+        report['missing_skus'] = [
+            sku for sku in skus if sku and sku.strip() not in products
+        ]
+        return report
+
+    def get_magento_updated_product_chunks(self, product_api, updated_after):
+        """
+        Generator of the products created or updated on magento since the
+        given time, in chunks of `magento_product_import_chunk_size`, as
+        tuples of None (there is no range to resume from) and the products.
+
+        :param product_api: Magento product API
+        :param updated_after: Datetime from which changes are listed
+        """
+        magento_products = product_api.list({
+            'updated_at': {
+                'from': updated_after.strftime(MAGENTO_DATETIME_FORMAT),
+            },
+        })
+        for magento_products_batch in batch(
+            magento_products, self.magento_product_import_chunk_size or 500
+        ):
+            yield None, magento_products_batch
+
+    def get_magento_product_chunks(
+        self, product_api, after_id=0, max_empty_chunks=10
+    ):
+        """
+        Generator of the products on magento, listed in ranges of
+        `magento_product_import_chunk_size` product IDs, as tuples of the
+        last ID of the range and the products in it.
+
+        Deleted products leave gaps in the IDs, so an empty range does not
+        end the listing: the next range is twice as wide, and the listing
+        ends after `max_empty_chunks` empty ranges in a row.
+
+        :param product_api: Magento product API
+        :param after_id: Product ID after which the listing starts
+        :param max_empty_chunks: Number of empty ranges in a row which end
+                                 the listing
+        """
+        chunk_size = self.magento_product_import_chunk_size or 500
+
+        width = chunk_size
+        empty_chunks = 0
+        while empty_chunks < max_empty_chunks:
+            last_id = after_id + width
+            magento_products = product_api.list({
+                'product_id': {'from': after_id + 1, 'to': last_id},
+            })
+            if magento_products:
+                empty_chunks = 0
+                width = chunk_size
+            else:
+                empty_chunks += 1
+                width *= 2
+            yield last_id, magento_products
+            after_id = last_id
 
     def import_product(self, sku, product_data=None):
         """
@@ -310,10 +735,7 @@ class Channel:
         if not products or not listings:
             # Either way we need the product data from magento. Make that
             # dreaded API call.
-            with magento.Product(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as product_api:
+            with self.magento_session('Product') as product_api:
                 product_data = product_api.info(sku, identifierType="sku")
 
                 # XXX: sanitize product_data, sometimes product sku may
@@ -334,6 +756,150 @@ class Channel:
 
         return product
 
+    def get_product(self, identifier, product_data=None):
+        """
+        Serve the product from the products resolved in bulk by
+        `magento_products` when there is one, else look it up as usual.
+
+        Downstream implementation for channel.get_product
+        """
+        Product = Pool().get('product.product')
+
+        if self.source == 'magento' and identifier:
+            product_id = (
+                Transaction().context.get('magento_product_ids') or {}
+            ).get(identifier.strip())
+            if product_id:
+                return Product(product_id)
+        return super(Channel, self).get_product(identifier, product_data)
+
+    @contextmanager
+    def magento_products(self, skus):
+        """
+        Resolve the products of the SKUs in bulk with `get_products_by_skus`
+        and serve `get_product` calls from them in the block
+
+        :param skus: List of SKUs
+        """
+        product_ids = dict(
+            Transaction().context.get('magento_product_ids') or {}
+        )
+        products = self.get_products_by_skus([
+            sku for sku in skus if sku and sku.strip() not in product_ids
+        ])
+        product_ids.update(
+            (sku, product.id) for sku, product in products.iteritems()
+        )
+        with Transaction().set_context(magento_product_ids=product_ids):
+            yield
+
+    def get_products_by_skus(self, skus, batch_size=50, update=False):
+        """
+        Find or create the products of the given SKUs in bulk. The products
+        and their listings on this channel are looked up with a single query
+        and only the SKUs missing either are fetched from magento, using
+        `catalog_product.info` multicalls.
+
+        :param skus: List of SKUs
+        :param batch_size: Number of products fetched in a single multicall
+        :param update: If True, all the SKUs are fetched from magento and
+                       the products found are updated with the data
+        :return: Dictionary of SKU to active record of product. SKUs which
+                 could not be fetched from magento are left out.
+        """
+        Product = Pool().get('product.product')
+        Listing = Pool().get('product.product.channel_listing')
+
+        cursor = Transaction().cursor
+        product = Product.__table__()
+        listing = Listing.__table__()
+
+        # Sanitize SKUs
+        skus = list(set(sku.strip() for sku in skus if sku and sku.strip()))
+
+        product_ids = {}
+        listed_skus = set()
+        # Listings disabled for their product missing on magento
+        missing_listing_ids = defaultdict(list)
+        for sub_skus in grouped_slice(skus):
+            cursor.execute(*product.join(
+                listing, 'LEFT', condition=(
+                    (listing.product == product.id) &
+                    (listing.channel == self.id)
+                )
+            ).select(
+                product.code, product.id, listing.id,
+                listing.magento_missing_since,
+                where=product.code.in_(list(sub_skus)) &
+                (product.active == True)  # noqa
+            ))
+            for code, product_id, listing_id, missing_since in \
+                    cursor.fetchall():
+                product_ids.setdefault(code, product_id)
+                if listing_id is None:
+                    continue
+                if missing_since is not None:
+                    missing_listing_ids[code].append(listing_id)
+                else:
+                    listed_skus.add(code)
+
+        missing_skus = [
+            sku for sku in skus
+            if update or sku not in product_ids or sku not in listed_skus
+        ]
+        if missing_skus:
+            with Transaction().set_context({'current_channel': self.id}):
+                with self.magento_session('Product') as product_api:
+                    for skus_batch in batch(missing_skus, batch_size):
+                        products_data = product_api.multiCall([
+                            ['catalog_product.info', [sku, None, None, 'sku']]
+                            for sku in skus_batch
+                        ])
+                        new_skus, new_products_data = [], []
+                        for sku, product_data in zip(
+                            skus_batch, products_data
+                        ):
+                            if product_data.get('isFault'):
+                                logger.warning("Product %s: %s %s" % (
+                                    sku, product_data['faultCode'],
+                                    product_data['faultMessage']
+                                ))
+                                continue
+
+                            # XXX: sanitize product_data, sometimes product
+                            # sku may contain trailing spaces
+                            product_data['sku'] = product_data['sku'].strip()
+
+                            if sku not in product_ids:
+                                new_skus.append(sku)
+                                new_products_data.append(product_data)
+                                continue
+                            if update:
+                                product = Product(product_ids[sku])
+                                product.update_from_magento_using_data(
+                                    product_data
+                                )
+                            if sku in missing_listing_ids:
+                                Listing.relink_using_magento_data(
+                                    Listing.browse(missing_listing_ids[sku]),
+                                    product_data
+                                )
+                            elif sku not in listed_skus:
+                                Listing.create_from(self, product_data)
+
+                        # Products are created along with their listings
+                        if new_products_data:
+                            products = Product.create_many_using_magento_data(
+                                new_products_data
+                            )
+                            for sku, product in zip(new_skus, products):
+                                product_ids[sku] = product.id
+
+        return dict(
+            (sku, Product(product_id))
+            for sku, product_id in product_ids.iteritems()
+        )
+
     def import_category_tree(self):
         """
         Imports the category tree and creates categories in a hierarchy same as
@@ -346,10 +912,7 @@ class Channel:
         self.validate_magento_channel()
 
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Category(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as category_api:
+            with self.magento_session('Category') as category_api:
                 category_tree = category_api.tree(
                     self.magento_root_category_id
                 )
@@ -364,16 +927,39 @@ class Channel:
         if self.source != 'magento':
             return super(Channel, self).import_orders()
 
-        new_sales = []
+        Sale = Pool().get('sale.sale')
+
+        if self.magento_order_import_run:
+            # The previous run did not complete, resume it after the last
+            # page it committed
+            logger.info(
+                "Resuming order import run %s of channel %s after page %s "
+                "(order %s)" % (
+                    self.magento_order_import_run, self.id,
+                    self.magento_order_import_page,
+                    self.magento_order_import_increment_id,
+                )
+            )
+        else:
+            self.write([self], {
+                'magento_order_import_run': uuid.uuid4().hex,
+                'magento_order_import_page': 0,
+                'magento_order_import_increment_id': None,
+                'magento_order_import_updated_at': None,
+            })
+            # Orders are committed in chunks, the run must be on record
+            # before the first of them
+            Transaction().cursor.commit()
+
+        sale_ids = []
         with Transaction().set_context({'current_channel': self.id}):
             order_states = self.get_order_states_to_import()
             order_states_to_import_in = map(
                 lambda state: state.code, order_states
             )
 
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
+            with self.magento_sync(), \
+                    self.magento_session('Order') as order_api:
                 # Filter orders store_id using list()
                 # then get info of each order using info()
                 # and call find_or_create_using_magento_data on sale
@@ -381,25 +967,218 @@ class Channel:
                     'store_id': {'=': self.magento_store_id},
                     'state': {'in': order_states_to_import_in},
                 }
-                self.write([self], {
-                    'last_order_import_time': datetime.utcnow()
-                })
-                page = 1
-                has_next = True
-                orders_summaries = []
-                while has_next:
-                    # XXX: Pagination is only available in
-                    # magento extension >= 1.6.1
-                    api_res = order_api.search(
-                        filters=filter, limit=3000, page=page
-                    )
-                    has_next = api_res['hasNext']
-                    page += 1
-                    orders_summaries.extend(api_res['items'])
+                if self.last_order_import_time:
+                    updated_after = self.last_order_import_time - \
+                        timedelta(
+                            minutes=self.magento_order_import_overlap or 0
+                        )
+                    filter['updated_at'] = {
+                        'gt': updated_after.strftime(MAGENTO_DATETIME_FORMAT)
+                    }
+                for page, orders_summaries in self.get_magento_order_pages(
+                    order_api, filter,
+                    page=(self.magento_order_import_page or 0) + 1
+                ):
+                    sale_ids.extend(map(
+                        int, self.import_orders_using_magento_summaries(
+                            orders_summaries
+                        )
+                    ))
 
-                for order_summary in orders_summaries:
-                    new_sales.append(self.import_order(order_summary))
-        return new_sales
+                    checkpoint = {'magento_order_import_page': page}
+                    if orders_summaries:
+                        checkpoint['magento_order_import_increment_id'] = \
+                            orders_summaries[-1]['increment_id']
+                    updated_times = [
+                        datetime.strptime(
+                            summary['updated_at'], MAGENTO_DATETIME_FORMAT
+                        ) for summary in orders_summaries
+                        if summary.get('updated_at')
+                    ]
+                    if self.magento_order_import_updated_at:
+                        updated_times.append(
+                            self.magento_order_import_updated_at
+                        )
+                    if updated_times:
+                        checkpoint['magento_order_import_updated_at'] = \
+                            max(updated_times)
+                    self.write([self], checkpoint)
+
+                    # Persist the orders of this page along with the
+                    # checkpoint before asking for the next one, a failure
+                    # loses at most one page of work
+                    Transaction().cursor.commit()
+
+            # The run is complete. Advance the watermark only as far as the
+            # orders processed, so that orders saved on magento during this
+            # run are not missed
+            values = {
+                'magento_order_import_run': None,
+                'magento_order_import_page': None,
+                'magento_order_import_increment_id': None,
+                'magento_order_import_updated_at': None,
+            }
+            if self.magento_order_import_updated_at and (
+                not self.last_order_import_time or
+                self.magento_order_import_updated_at >
+                self.last_order_import_time
+            ):
+                values['last_order_import_time'] = \
+                    self.magento_order_import_updated_at
+            self.write([self], values)
+        return Sale.browse(sale_ids)
+
+    def get_magento_order_pages(
+        self, order_api, filter, page=1, page_size=3000
+    ):
+        """
+        Generator of the pages of order summaries matching the filter, as
+        tuples of page number and summaries. A page is requested from
+        magento only when the previous one has been consumed.
+
+        Pages are read by offset, as magento does not tell the order of the
+        summaries it returns. An order which is updated while the pages
+        are read may be read twice, or moved to a page already read and
+        skipped: it is then updated after the start of the run, so the
+        next run, which reads from the last update imported, finds it.
+
+        :param order_api: Magento order API
+        :param filter: Search filters for magento orders
+        :param page: Number of the first page to fetch
+        :param page_size: Number of order summaries in a page
+        """
+        has_next = True
+        while has_next:
+            # XXX: Pagination is only available in
+            # magento extension >= 1.6.1
+            api_res = order_api.search(
+                filters=filter, limit=page_size, page=page
+            )
+            has_next = api_res['hasNext']
+            yield page, api_res['items']
+            page += 1
+
+    def import_orders_using_magento_summaries(self, orders_summaries):
+        """
+        Import the orders of the given summaries. Orders already imported
+        are looked up with a single query and the details of the others are
+        fetched from magento with `info_multi` in batches of
+        `magento_order_batch_size`. The sales created are committed in
+        chunks of `magento_order_commit_size`. An order whose details
+        magento fails to send is recorded as a channel exception, as the
+        run moves past it.
+
+        :param orders_summaries: List of order summaries from `search`
+        :return: List of active record of sale found/imported
+        """
+        Sale = Pool().get('sale.sale')
+        ChannelException = Pool().get('channel.exception')
+
+        imported_sales = Sale.find_many_using_magento_ids(self, [
+            int(summary['order_id']) for summary in orders_summaries
+        ])
+        sale_ids = map(int, imported_sales.values())
+        orders_to_create = []
+
+        increment_ids = [
+            summary['increment_id'] for summary in orders_summaries
+            if int(summary['order_id']) not in imported_sales
+        ]
+        with Transaction().set_context({'current_channel': self.id}):
+            with self.magento_session('Order') as order_api:
+                for increment_ids_batch in batch(
+                    increment_ids, self.magento_order_batch_size or 50
+                ):
+                    orders_data = order_api.info_multi(increment_ids_batch)
+
+                    exceptions = []
+                    for i, order_data in enumerate(orders_data):
+                        if order_data.get('isFault'):
+                            logger.warning("Order %s: %s %s" % (
+                                increment_ids_batch[i],
+                                order_data['faultCode'],
+                                order_data['faultMessage']
+                            ))
+                            exceptions.append({
+                                'origin': '%s,%s' % (self.__name__, self.id),
+                                'log': (
+                                    "Error occurred on fetching order %s.\n"
+                                    "Error Message: %s %s" % (
+                                        increment_ids_batch[i],
+                                        order_data['faultCode'],
+                                        order_data['faultMessage']
+                                    )
+                                ),
+                                'channel': self.id,
+                            })
+                            continue
+                        orders_to_create.append(order_data)
+                    if exceptions:
+                        ChannelException.create(exceptions)
+
+                    if len(orders_to_create) >= \
+                            (self.magento_order_commit_size or 100):
+                        sale_ids.extend(
+                            self.create_magento_orders(orders_to_create)
+                        )
+                        orders_to_create = []
+
+            if orders_to_create:
+                sale_ids.extend(self.create_magento_orders(orders_to_create))
+        return Sale.browse(sale_ids)
+
+    def create_magento_orders(self, orders_data):
+        """
+        Create sales for the given orders and commit them together. The
+        products of all the orders are resolved in bulk first. An order
+        which fails is recorded as a channel exception and skipped: the
+        chunk is rolled back and created again without it.
+
+        :param orders_data: List of order data from magento
+        :return: List of IDs of the sales created
+        """
+        Sale = Pool().get('sale.sale')
+        ChannelException = Pool().get('channel.exception')
+
+        orders_data = list(orders_data)
+        while True:
+            sale_ids = []
+            skus = []
+            for order_data in orders_data:
+                skus.extend(Sale.get_skus_using_magento_data(order_data))
+
+            with self.magento_products(skus):
+                for order_data in orders_data:
+                    try:
+                        sale = Sale.create_using_magento_data(order_data)
+                    except Exception, exc:
+                        break
+                    if sale:
+                        sale_ids.append(sale.id)
+                else:
+                    Transaction().cursor.commit()
+                    return sale_ids
+
+            logger.exception(
+                "Order %s could not be imported" % order_data['increment_id']
+            )
+            Transaction().cursor.rollback()
+            # Records memoised by the run may have been rolled back
+            with self.magento_sync() as manager:
+                manager.memos.clear()
+            ChannelException.create([{
+                'origin': '%s,%s' % (self.__name__, self.id),
+                'log': (
+                    "Error occurred on importing order %s.\nError "
+                    "Message: %s" % (
+                        order_data['increment_id'],
+                        getattr(exc, 'message', None) or repr(exc)
+                    )
+                ),
+                'channel': self.id,
+            }])
+            Transaction().cursor.commit()
+            orders_data.remove(order_data)
 
     def import_order(self, order_info):
         "Downstream implementation to import sale order from magento"
@@ -413,23 +1192,19 @@ class Channel:
             return sale
 
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
+            with self.magento_session('Order') as order_api:
                 order_data = order_api.info(order_info['increment_id'])
                 return Sale.create_using_magento_data(order_data)
 
     @classmethod
     def export_order_status_to_magento_using_cron(cls):
         """
-        Export sales orders status to magento using cron
-
-        :param store_views: List of active record of store view
+        Export sales orders status to magento using cron. The channels are
+        exported in parallel, each in a transaction of its own.
         """
         channels = cls.search([('source', '=', 'magento')])
 
-        for channel in channels:
-            channel.export_order_status()
+        run_channel_jobs(channels, 'export_order_status')
 
     def export_order_status(self):
         """
@@ -457,8 +1232,9 @@ class Channel:
         self.last_order_export_time = datetime.utcnow()
         self.save()
 
-        for sale in sales:
-            exported_sales.append(sale.export_order_status_to_magento())
+        with self.magento_sync():
+            for sale in sales:
+                exported_sales.append(sale.export_order_status_to_magento())
 
         return exported_sales
 
@@ -496,21 +1272,22 @@ class Channel:
         category = Category(
             ModelData.get_id("magento", "product_category_magento_unclassified")
         )
-        for product in products:
-            exported_products.append(
-                product.export_product_catalog_to_magento(category)
-            )
+        with self.magento_sync():
+            for product in products:
+                exported_products.append(
+                    product.export_product_catalog_to_magento(category)
+                )
         return exported_products
 
     @classmethod
     def export_shipment_status_to_magento_using_cron(cls):
         """
-        Export Shipment status for shipments using cron
+        Export Shipment status for shipments using cron. The channels are
+        exported in parallel, each in a transaction of its own.
         """
         channels = cls.search([('source', '=', 'magento')])
 
-        for channel in channels:
-            channel.export_shipment_status_to_magento()
+        run_channel_jobs(channels, 'export_shipment_status_to_magento')
 
     def export_shipment_status_to_magento(self):
         """
@@ -542,67 +1319,72 @@ class Channel:
         self.save()
 
         updated_sales = set([])
-        for sale in sales:
-            # Get the increment id from the sale reference
-            increment_id = sale.reference[
-                len(self.magento_order_prefix): len(sale.reference)
-            ]
-
-            for shipment in sale.shipments:
-                try:
-                    # Some checks to make sure that only valid shipments are
-                    # being exported
-                    if shipment.is_tracking_exported_to_magento or \
-                            shipment.state != 'done' or \
-                            shipment.magento_increment_id:
-                        continue
-                    updated_sales.add(sale)
-                    with magento.Shipment(
-                        self.magento_url, self.magento_api_user,
-                        self.magento_api_key
-                    ) as shipment_api:
-                        item_qty_map = {}
-                        for move in shipment.outgoing_moves:
-                            if isinstance(move.origin, SaleLine) \
-                                    and move.origin.magento_id:
-                                # This is done because there can be multiple
-                                # lines with the same product and they need
-                                # to be send as a sum of quanitities
-                                item_qty_map.setdefault(
-                                    str(move.origin.magento_id), 0
-                                )
-                                item_qty_map[str(move.origin.magento_id)] += \
-                                    move.quantity
-                        shipment_increment_id = shipment_api.create(
-                            order_increment_id=increment_id,
-                            items_qty=item_qty_map
-                        )
-                        Shipment.write(list(sale.shipments), {
-                            'magento_increment_id': shipment_increment_id,
-                        })
-
-                        if self.magento_export_tracking_information and (
-                            hasattr(shipment, 'tracking_number') and
-                            hasattr(shipment, 'carrier') and
-                            shipment.tracking_number and shipment.carrier
-                        ):
-                            with Transaction().set_context(
-                                    current_channel=self.id):
-                                shipment.export_tracking_info_to_magento()
-                except xmlrpclib.Fault, fault:
-                    if fault.faultCode == 102:
-                        # A shipment already exists for this order,
-                        # we cannot do anything about it.
-                        # Maybe it was already exported earlier or was created
-                        # separately on magento
-                        # Hence, just continue
-                        continue
+        with self.magento_sync():
+            for sale in sales:
+                # Get the increment id from the sale reference
+                increment_id = sale.reference[
+                    len(self.magento_order_prefix): len(sale.reference)
+                ]
+
+                for shipment in sale.shipments:
+                    try:
+                        # Some checks to make sure that only valid shipments
+                        # are being exported
+                        if shipment.is_tracking_exported_to_magento or \
+                                shipment.state != 'done' or \
+                                shipment.magento_increment_id:
+                            continue
+                        updated_sales.add(sale)
+                        with self.magento_session('Shipment') as shipment_api:
+                            item_qty_map = {}
+                            for move in shipment.outgoing_moves:
+                                if isinstance(move.origin, SaleLine) \
+                                        and move.origin.magento_id:
+                                    # This is done because there can be
+                                    # multiple lines with the same product and
+                                    # they need to be send as a sum of
+                                    # quanitities
+                                    item_id = str(move.origin.magento_id)
+                                    item_qty_map.setdefault(item_id, 0)
+                                    item_qty_map[item_id] += move.quantity
+                            shipment_increment_id = shipment_api.create(
+                                order_increment_id=increment_id,
+                                items_qty=item_qty_map
+                            )
+                            Shipment.write(list(sale.shipments), {
+                                'magento_increment_id': shipment_increment_id,
+                            })
+
+                            if self.magento_export_tracking_information and (
+                                hasattr(shipment, 'tracking_number') and
+                                hasattr(shipment, 'carrier') and
+                                shipment.tracking_number and
+                                shipment.carrier
+                            ):
+                                with Transaction().set_context(
+                                        current_channel=self.id):
+                                    shipment.export_tracking_info_to_magento()
+                    except xmlrpclib.Fault, fault:
+                        if fault.faultCode == 102:
+                            # A shipment already exists for this order,
+                            # we cannot do anything about it.
+                            # Maybe it was already exported earlier or was
+                            # created separately on magento
+                            # Hence, just continue
+                            continue
 
         return updated_sales
 
-    def export_product_prices(self):
+    def export_product_prices(self, batch_size=50):
         """
-        Exports tier prices of products from tryton to magento for this channel
+        Exports tier prices of products from tryton to magento for this
+        channel. The prices are sent over a single session, in multicalls of
+        `catalog_product_attribute_tier_price.update`. The listings whose
+        product is missing on magento are disabled. If magento refuses the
+        prices of other products, the last export time is not advanced, so
+        that they are sent again by the next export.
+
+        :param batch_size: Number of products updated in a single multicall
         :return: List of products
         """
         if self.source != 'magento':
@@ -612,6 +1394,7 @@ class Channel:
 
         price_domain = [
             ('channel', '=', self.id),
+            ('state', '=', 'active'),
         ]
 
         if self.last_product_price_export_time:
@@ -627,9 +1410,11 @@ class Channel:
 
         product_listings = ChannelListing.search(price_domain)
 
+        last_export_time = self.last_product_price_export_time
         self.last_product_price_export_time = datetime.utcnow()
         self.save()
 
+        listing_calls = []
         for listing in product_listings:
 
             # Get the price tiers from the product listing if the list has
@@ -640,8 +1425,9 @@ class Channel:
             price_data = []
             for tier in price_tiers:
                 if hasattr(tier, 'product_listing'):
-                    # The price tier comes from a product listing, then it has a
-                    # function field for price, we use it directly
+                    # The price tier comes from a product listing, then
+                    # it has a function field for price, we use it
+                    # directly
                     price = tier.price
                 else:
                     # The price tier comes from the default tiers on
@@ -658,14 +1444,43 @@ class Channel:
                     'price': float(price),
                 })
 
-            # Update stock information to magento
-            with magento.ProductTierPrice(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as tier_price_api:
-                tier_price_api.update(
-                    listing.product_identifier, price_data,
-                    identifierType="productID"
-                )
+            listing_calls.append((listing, [
+                'catalog_product_attribute_tier_price.update',
+                [listing.product_identifier, price_data, 'productID']
+            ]))
+
+        missing, failed = [], []
+        with self.magento_session('ProductTierPrice') as tier_price_api:
+            for listing_calls_batch in batch(listing_calls, batch_size):
+                results = tier_price_api.multiCall([
+                    call for _, call in listing_calls_batch
+                ])
+                # Faults of the products are returned as dictionaries
+                for (listing, _), result in zip(listing_calls_batch, results):
+                    if not isinstance(result, dict) or \
+                            not result.get('isFault'):
+                        continue
+                    logger.warning(
+                        "Tier prices of product %s not exported to "
+                        "channel %s: %s %s" % (
+                            listing.product_identifier, self.id,
+                            result.get('faultCode'),
+                            result.get('faultMessage')
+                        )
+                    )
+                    if str(result.get('faultCode')) == \
+                            str(PRODUCT_NOT_EXISTS_FAULT):
+                        missing.append(listing)
+                    else:
+                        failed.append(listing)
+
+        if missing:
+            ChannelListing.mark_missing_on_magento(missing)
+
+        if failed:
+            # Send the prices refused again next time
+            self.last_product_price_export_time = last_export_time
+            self.save()
 
         return len(product_listings)
 
@@ -724,28 +1539,28 @@ class Channel:
             ('state', 'in', ('confirmed', 'processing')),
         ])
         order_ids = [sale.reference for sale in sales]
-        for order_ids_batch in batch(order_ids, 50):
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
+        with self.magento_session('Order') as order_api:
+            for order_ids_batch in batch(order_ids, 50):
                 orders_data = order_api.info_multi(order_ids_batch)
 
-            for i, order_data in enumerate(orders_data):
-                if order_data.get('isFault'):
-                    if order_data['faultCode'] == '100':
-                        # 100: Requested order not exists.
-                        # TODO: Remove order from channel or add some
-                        # exception.
-                        pass
-                    logger.warning("Order %s: %s %s" % (
-                        order_ids_batch[i], order_data['faultCode'],
-                        order_data['faultMessage']
-                    ))
-                    continue
-                sale, = Sale.search([
-                    ('reference', '=', order_data['increment_id'])
-                ])
-                sale.update_order_status_from_magento(order_data=order_data)
+                for i, order_data in enumerate(orders_data):
+                    if order_data.get('isFault'):
+                        if order_data['faultCode'] == '100':
+                            # 100: Requested order not exists.
+                            # TODO: Remove order from channel or add some
+                            # exception.
+                            pass
+                        logger.warning("Order %s: %s %s" % (
+                            order_ids_batch[i], order_data['faultCode'],
+                            order_data['faultMessage']
+                        ))
+                        continue
+                    sale, = Sale.search([
+                        ('reference', '=', order_data['increment_id'])
+                    ])
+                    sale.update_order_status_from_magento(
+                        order_data=order_data
+                    )
 
 
 class MagentoTier(ModelSQL, ModelView):
@@ -776,3 +1591,22 @@ class MagentoTier(ModelSQL, ModelView):
                 'Quantity in price tiers must be unique for a channel'
             )
         ]
+
+
+class ChannelException:
+    """
+    Channel Exception
+    """
+    __name__ = 'channel.exception'
+
+    __metaclass__ = PoolMeta
+
+    @classmethod
+    def models_get(cls):
+        """
+        Allow exceptions on channels, for orders which could not be imported
+        at all
+        """
+        return super(ChannelException, cls).models_get() + [
+            ('sale.channel', 'Channel'),
+        ]
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from trytond.pool import PoolMeta
+from trytond.cache import Cache
 
 
 __all__ = ['Country', 'Subdivision']
@@ -10,6 +11,12 @@ class Country:
     "Country"
     __name__ = 'country.country'
 
+    #: Map of ISO codes to country IDs, loaded once and cleared whenever
+    #: countries are changed.
+    _magento_code_cache = Cache(
+        'country.country.search_using_magento_code', context=False
+    )
+
     @classmethod
     def __setup__(cls):
         """
@@ -20,6 +27,36 @@ class Country:
             'country_not_found': 'Country with ISO code %s does not exist.',
         })
 
+    @classmethod
+    def create(cls, vlist):
+        cls._magento_code_cache.clear()
+        return super(Country, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._magento_code_cache.clear()
+        super(Country, cls).write(*args)
+
+    @classmethod
+    def delete(cls, countries):
+        cls._magento_code_cache.clear()
+        super(Country, cls).delete(countries)
+
+    @classmethod
+    def get_magento_code_map(cls):
+        """
+        Returns a map of ISO codes to country IDs. All countries are loaded
+        with a single query on the first call and served from the cache
+        after that.
+        """
+        code_map = cls._magento_code_cache.get(None)
+        if code_map is None:
+            code_map = dict(
+                (country.code, country.id) for country in cls.search([])
+            )
+            cls._magento_code_cache.set(None, code_map)
+        return code_map
+
     @classmethod
     def search_using_magento_code(cls, code):
         """
@@ -28,37 +65,75 @@ class Country:
         :param code: ISO code of country
         :return: Browse record of country if found else raises error
         """
-        countries = cls.search([('code', '=', code)])
+        country_id = cls.get_magento_code_map().get(code)
 
-        if not countries:
+        if country_id is None:
             return cls.raise_user_error(
                 "country_not_found", error_args=(code, )
             )
 
-        return countries[0]
+        return cls(country_id)
 
 
 class Subdivision:
     "Subdivision"
     __name__ = 'country.subdivision'
 
+    #: Map of country IDs to maps of lower cased subdivision names to
+    #: subdivision IDs, cleared whenever subdivisions are changed.
+    _magento_region_cache = Cache(
+        'country.subdivision.search_using_magento_region', context=False
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        cls._magento_region_cache.clear()
+        return super(Subdivision, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._magento_region_cache.clear()
+        super(Subdivision, cls).write(*args)
+
+    @classmethod
+    def delete(cls, subdivisions):
+        cls._magento_region_cache.clear()
+        super(Subdivision, cls).delete(subdivisions)
+
+    @classmethod
+    def get_magento_region_map(cls, country):
+        """
+        Returns a map of lower cased names to IDs of the subdivisions of the
+        country. The subdivisions of a country are loaded with a single
+        query on the first call and served from the cache after that.
+
+        :param country: Active record of country
+        """
+        region_map = cls._magento_region_cache.get(country.id)
+        if region_map is None:
+            region_map = {}
+            for subdivision in cls.search([('country', '=', country.id)]):
+                region_map.setdefault(
+                    subdivision.name.lower(), subdivision.id
+                )
+            cls._magento_region_cache.set(country.id, region_map)
+        return region_map
+
     @classmethod
     def search_using_magento_region(cls, region, country):
         """
         Searches for state with given magento region.
         Magento does not send state code but it just sends region name
-        thats why subdivisions here are searched using a case insensitive
-        search
+        thats why subdivisions here are matched case insensitively
 
         :param region: Name of state from magento
         :param country: Active record of country
         :return: Active record of state if found else raises error
         """
-        subdivisions = cls.search([
-            ('name', 'ilike', region),
-            ('country', '=', country.id),
-        ])
+        subdivision_id = cls.get_magento_region_map(country).get(
+            region.lower()
+        )
 
         # TODO: Exception need be created if subdivison does not exist.
 
-        return subdivisions and subdivisions[0] or None
+        return subdivision_id is not None and cls(subdivision_id) or None
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from trytond.pool import PoolMeta
+from trytond.cache import Cache
 
 
 __all__ = ['Currency']
@@ -10,6 +11,12 @@ class Currency:
     "Currency"
     __name__ = 'currency.currency'
 
+    #: Map of codes to currency IDs, loaded once and cleared whenever
+    #: currencies are changed.
+    _magento_code_cache = Cache(
+        'currency.currency.search_using_magento_code', context=False
+    )
+
     @classmethod
     def __setup__(cls):
         """
@@ -20,6 +27,36 @@ class Currency:
             'currency_not_found': 'Currency with code %s does not exist.',
         })
 
+    @classmethod
+    def create(cls, vlist):
+        cls._magento_code_cache.clear()
+        return super(Currency, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._magento_code_cache.clear()
+        super(Currency, cls).write(*args)
+
+    @classmethod
+    def delete(cls, currencies):
+        cls._magento_code_cache.clear()
+        super(Currency, cls).delete(currencies)
+
+    @classmethod
+    def get_magento_code_map(cls):
+        """
+        Returns a map of codes to currency IDs. All currencies are loaded
+        with a single query on the first call and served from the cache
+        after that.
+        """
+        code_map = cls._magento_code_cache.get(None)
+        if code_map is None:
+            code_map = dict(
+                (currency.code, currency.id) for currency in cls.search([])
+            )
+            cls._magento_code_cache.set(None, code_map)
+        return code_map
+
     @classmethod
     def search_using_magento_code(cls, currency_code):
         """
@@ -28,9 +65,9 @@ class Currency:
         :param currency_code: currency code given by magento
         :return: Active record of currency if found else raises error
         """
-        currencies = cls.search([('code', '=', currency_code)])
+        currency_id = cls.get_magento_code_map().get(currency_code)
 
-        if not currencies:
+        if currency_id is None:
             return cls.raise_user_error('currency_not_found', (currency_code, ))
 
-        return currencies[0]
+        return cls(currency_id)
@@ -1,6 +1,4 @@
 # -*- coding: utf-8 -*-
-import magento
-
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
@@ -44,10 +42,7 @@ class Party:
 
         party = cls.find_using_magento_id(magento_id)
         if not party:
-            with magento.Customer(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as customer_api:
+            with channel.magento_session('Customer') as customer_api:
                 customer_data = customer_api.info(magento_id)
 
             party = cls.create_using_magento_data(customer_data)
@@ -1,6 +1,9 @@
 # -*- coding: UTF-8 -*-
-import magento
+import logging
+import xmlrpclib
+from datetime import datetime
 from collections import defaultdict
+from functools import partial
 
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.transaction import Transaction
@@ -8,6 +11,12 @@ from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval
 from decimal import Decimal
 
+from .api import (
+    SessionManager, AdaptiveBatcher, get_active_sessions,
+    PRODUCT_NOT_EXISTS_FAULT
+)
+from .scheduler import run_channel_calls
+
 
 __all__ = [
     'Category', 'MagentoInstanceCategory', 'Product',
@@ -16,6 +25,8 @@ __all__ = [
 ]
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger('magento')
+
 
 def batch(iterable, n=1):
     l = len(iterable)
@@ -35,20 +46,69 @@ class Category:
     @classmethod
     def create_tree_using_magento_data(cls, category_tree):
         """
-        Create the categories from the category tree
+        Create the categories from the category tree and bring the existing
+        ones in sync with it. The categories of the channel are loaded once
+        and the tree is walked level by level, creating the categories
+        missing on each level at once. Categories renamed or moved under
+        another parent on magento are updated with a single write.
 
         :param category_tree: Category Tree from Magento
         """
-        # Create the root
-        root_category = cls.find_or_create_using_magento_data(
-            category_tree
+        MagentoCategory = Pool().get('magento.instance.product_category')
+
+        existing = MagentoCategory.get_category_map(
+            Transaction().context['current_channel']
         )
-        for child in category_tree['children']:
-            cls.find_or_create_using_magento_data(
-                child, parent=root_category
-            )
-            if child['children']:
-                cls.create_tree_using_magento_data(child)
+        category_ids = dict(
+            (magento_id, values[0])
+            for magento_id, values in existing.iteritems()
+        )
+
+        to_write = defaultdict(list)
+        # Nodes of the level along with the magento ID of their parent
+        level = [(category_tree, None)]
+        while level:
+            missing = []
+            for node, parent_id in level:
+                magento_id = int(node['category_id'])
+                if magento_id not in existing:
+                    missing.append((node, parent_id))
+                    continue
+
+                category_id, name, current_parent = existing[magento_id]
+                values = {}
+                if node['name'] != name:
+                    values['name'] = node['name']
+                # The root is left wherever it was placed in tryton
+                if parent_id is not None and \
+                        current_parent != category_ids[parent_id]:
+                    values['parent'] = category_ids[parent_id]
+                if values:
+                    to_write[tuple(sorted(values.items()))].append(
+                        category_id
+                    )
+
+            if missing:
+                categories = cls.create([
+                    cls.get_values_using_magento_data(
+                        node, category_ids.get(parent_id)
+                    ) for node, parent_id in missing
+                ])
+                for (node, _), category in zip(missing, categories):
+                    category_ids[int(node['category_id'])] = category.id
+                # Categories memoised as missing may exist now
+                cls.get_magento_id_memo().clear()
+
+            level = [
+                (child, int(node['category_id']))
+                for node, _ in level for child in node['children']
+            ]
+
+        if to_write:
+            args = []
+            for values, category_ids_to_write in to_write.iteritems():
+                args.extend((cls.browse(category_ids_to_write), dict(values)))
+            cls.write(*args)
 
     @classmethod
     def find_or_create_using_magento_data(
@@ -76,30 +136,61 @@ class Category:
         cls, magento_id, parent=None
     ):
         """
-        Find or Create Category Using Magento ID of Category
+        Find or Create Category Using Magento ID of Category. The results
+        are memoised for the sync run, or the transaction outside of one,
+        including the categories which do not exist on magento.
 
         :param category_data: Category Data from Magento
         :param parent: Browse record of Parent if present, else None
-        :returns: Active record of category found/created
+        :returns: Active record of category found/created, None if the
+                  category does not exist on magento
         """
         Channel = Pool().get('sale.channel')
 
+        memo = cls.get_magento_id_memo()
+        key = (Transaction().context['current_channel'], magento_id)
+        if key in memo:
+            return memo[key] is not None and cls(memo[key]) or None
+
         category = cls.find_using_magento_id(magento_id)
         if not category:
             channel = Channel.get_current_magento_channel()
 
-            with magento.Category(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as category_api:
-                category_data = category_api.info(magento_id)
-
-            category = cls.create_using_magento_data(
-                category_data, parent
-            )
+            try:
+                with channel.magento_session('Category') as category_api:
+                    category_data = category_api.info(magento_id)
+            except xmlrpclib.Fault, exception:
+                if exception.faultCode != 102:
+                    raise
+                # Category does not exist on magento
+                category = None
+            else:
+                category = cls.create_using_magento_data(
+                    category_data, parent
+                )
 
+        memo[key] = category and category.id
         return category
 
+    @staticmethod
+    def get_magento_id_memo():
+        """
+        Returns the memo of the category IDs found by magento ID, keyed by
+        channel and magento ID. Within a sync run of the current channel it
+        is kept by the run, across the commits of the run, else it lives in
+        the records cache of the transaction.
+        """
+        manager = get_active_sessions().get(
+            Transaction().context.get('current_channel')
+        )
+        if manager is not None:
+            return manager.memos.setdefault(
+                'magento.product_category.magento_id', {}
+            )
+        return Transaction().cursor.get_cache().setdefault(
+            'magento.product_category.magento_id', {}
+        )
+
     @classmethod
     def find_using_magento_data(cls, category_data):
         """
@@ -143,16 +234,30 @@ class Category:
         :param parent: Browse record of Parent if present, else None
         :returns: Active record of category created
         """
-        category, = cls.create([{
+        category, = cls.create([
+            cls.get_values_using_magento_data(category_data, parent)
+        ])
+
+        return category
+
+    @classmethod
+    def get_values_using_magento_data(cls, category_data, parent=None):
+        """
+        Returns the values to create a category, mapped to the current
+        channel, from magento data
+
+        :param category_data: Category Data from magento
+        :param parent: Active record or ID of Parent if present, else None
+        :returns: Dictionary of values
+        """
+        return {
             'name': category_data['name'],
             'parent': parent,
             'magento_ids': [('create', [{
                 'magento_id': int(category_data['category_id']),
                 'channel': Transaction().context['current_channel'],
             }])],
-        }])
-
-        return category
+        }
 
 
 class MagentoInstanceCategory(ModelSQL, ModelView):
@@ -190,6 +295,32 @@ class MagentoInstanceCategory(ModelSQL, ModelView):
             )
         ]
 
+    @classmethod
+    def get_category_map(cls, channel_id):
+        """
+        Returns a map of the magento IDs of the categories of the channel to
+        tuples of the ID, name and parent ID of their categories, read with a
+        single query
+
+        :param channel_id: ID of the channel
+        """
+        Category = Pool().get('product.category')
+
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        category = Category.__table__()
+
+        cursor.execute(*table.join(
+            category, condition=(table.category == category.id)
+        ).select(
+            table.magento_id, category.id, category.name, category.parent,
+            where=(table.channel == channel_id)
+        ))
+        return dict(
+            (magento_id, (category_id, name, parent))
+            for magento_id, category_id, name, parent in cursor.fetchall()
+        )
+
 
 class ProductSaleChannelListing:
     "Product Sale Channel"
@@ -212,6 +343,27 @@ class ProductSaleChannelListing:
         }, depends=['channel_source']
     )
 
+    #: Inventory last exported to magento, a listing is exported again only
+    #: once these change
+    magento_exported_quantity = fields.Float(
+        'Exported Quantity', readonly=True, states={
+            "invisible": Eval('channel_source') != 'magento'
+        }, depends=['channel_source']
+    )
+    magento_exported_in_stock = fields.Boolean(
+        'Exported In Stock', readonly=True, states={
+            "invisible": Eval('channel_source') != 'magento'
+        }, depends=['channel_source']
+    )
+
+    #: Set when magento reported the product of the listing as missing. The
+    #: listing is disabled then, until the product is imported again.
+    magento_missing_since = fields.DateTime(
+        'Missing on Magento Since', readonly=True, states={
+            "invisible": Eval('channel_source') != 'magento'
+        }, depends=['channel_source']
+    )
+
     @classmethod
     def create_from(cls, channel, product_data):
         """
@@ -242,6 +394,44 @@ class ProductSaleChannelListing:
         listing.save()
         return listing
 
+    @classmethod
+    def mark_missing_on_magento(cls, listings):
+        """
+        Disables the listings whose product magento reported as missing.
+        They are left out of the exports until the product is imported
+        again.
+
+        :param listings: List of active records of listings
+        """
+        cls.write(listings, {
+            'state': 'disabled',
+            'magento_missing_since': datetime.utcnow(),
+        })
+
+    @classmethod
+    def relink_using_magento_data(cls, listings, product_data):
+        """
+        Links the listings disabled for their product missing on magento to
+        the product again, as found in the data
+
+        :param listings: List of active records of listings
+        :param product_data: Product Data from Magento
+        """
+        listings = [
+            listing for listing in listings if listing.magento_missing_since
+        ]
+        if not listings:
+            return
+        cls.write(listings, {
+            'state': 'active',
+            'product_identifier': product_data['product_id'],
+            'magento_product_type': product_data['type'],
+            'magento_missing_since': None,
+            # Nothing is known of the inventory of the product on magento
+            'magento_exported_quantity': None,
+            'magento_exported_in_stock': None,
+        })
+
     def export_inventory(self):
         """
         Export inventory of this listing
@@ -254,64 +444,234 @@ class ProductSaleChannelListing:
     @classmethod
     def export_bulk_inventory(cls, listings):
         """
-        Bulk export inventory to magento.
+        Bulk export inventory to magento. Only the listings whose quantity
+        or stock status changed since they were last exported are sent.
 
         Do not rely on the return value from this method.
         """
+        Channel = Pool().get('sale.channel')
+
         if not listings:
             # Nothing to update
             return
 
-        non_magento_listings = cls.search([
-            ('id', 'in', map(int, listings)),
-            ('channel.source', '!=', 'magento'),
-        ])
+        non_magento_listings, inventory_channel_map = \
+            cls._get_inventory_deltas_by_channel(listings)
+
         if non_magento_listings:
             super(ProductSaleChannelListing, cls).export_bulk_inventory(
                 non_magento_listings
             )
-        magento_listings = filter(
-            lambda l: l not in non_magento_listings, listings
-        )
 
+        # Channels are pushed concurrently, outside of the transaction
+        calls = []
+        for channel, listing_data_list in inventory_channel_map.iteritems():
+            calls.append((channel, partial(
+                cls.push_magento_inventory,
+                (
+                    channel.magento_url, channel.magento_api_user,
+                    channel.magento_api_key, channel.magento_call_timeout
+                ),
+                [
+                    (listing.id, listing_data)
+                    for listing, listing_data in listing_data_list
+                ],
+                AdaptiveBatcher(
+                    channel.magento_inventory_tuned_batch_size or
+                    channel.magento_inventory_batch_size,
+                    channel.magento_inventory_batch_time
+                )
+            )))
+
+        exported = defaultdict(list)
+        batch_sizes = defaultdict(list)
+        failed = []
+        for channel_id, (result, error) in \
+                run_channel_calls(calls).iteritems():
+            if error is not None:
+                # Logged already, the listings are sent again next time
+                continue
+            responses, batch_size = result
+            if batch_size != \
+                    Channel(channel_id).magento_inventory_tuned_batch_size:
+                batch_sizes[batch_size].append(channel_id)
+            for listing_id, (identifier, product_data), result in responses:
+                if result is not True:
+                    failed.append((channel_id, listing_id, identifier, result))
+                    continue
+                exported[(
+                    product_data['qty'],
+                    product_data['is_in_stock'] == '1'
+                )].append(listing_id)
+
+        cls.set_magento_exported_inventory(exported)
+        cls.handle_magento_inventory_faults(failed)
+
+        # Remember the batch size tuned for each channel for the next runs
+        args = []
+        for batch_size, channel_ids in batch_sizes.iteritems():
+            args.extend((Channel.browse(channel_ids), {
+                'magento_inventory_tuned_batch_size': batch_size,
+            }))
+        if args:
+            Channel.write(*args)
+
+    @classmethod
+    def _get_inventory_deltas_by_channel(cls, listings):
+        """
+        Splits the listings by the source of their channel, which is read
+        once per channel, and groups the inventory of the active magento
+        listings which changed since it was last exported by channel
+
+        :param listings: List of active records of listings
+        :return: Tuple of the list of listings of other channels and a
+                 dictionary of channel to the list of tuples of listing and
+                 the identifier and inventory data of its product
+        """
+        sources = {}
+        non_magento_listings = []
         inventory_channel_map = defaultdict(list)
-        for listing in magento_listings:
+        for listing in listings:
             channel = listing.channel
+            if channel.id not in sources:
+                sources[channel.id] = channel.source
+            if sources[channel.id] != 'magento':
+                non_magento_listings.append(listing)
+                continue
 
-            product_data = {
-                'qty': listing.quantity,
-            }
+            if listing.state != 'active':
+                # Includes the listings missing on magento
+                continue
 
-            # TODO: Get this from availability used
-            if listing.magento_product_type == 'simple':
-                # Only send inventory for simple products
-                product_data['is_in_stock'] = '1' \
-                    if listing.quantity > 0 else '0'
-            else:
-                # configurable, bundle and everything else
-                product_data['is_in_stock'] = '1'
+            product_data = listing.get_magento_inventory_data()
+            if listing.is_magento_inventory_exported(product_data):
+                # Magento already has this inventory
+                continue
 
             # group inventory xml by channel
-            inventory_channel_map[channel].append([
+            inventory_channel_map[channel].append((listing, [
                 listing.product_identifier, product_data
-            ])
+            ]))
 
-        for channel, product_data_list in inventory_channel_map.iteritems():
-            with magento.Inventory(
-                    channel.magento_url,
-                    channel.magento_api_user,
-                    channel.magento_api_key) as inventory_api:
-                for product_data_batch in batch(product_data_list, 50):
-                    response = inventory_api.update_multi(product_data_batch)
-                    # Magento bulk API will not raise Faults.
-                    # Instead the response contains the faults as a dict
-                    for result in response:
-                        if result is not True:
-                            # TODO: True when success, dictionary of fault
-                            # when the product is not there
-                            # 1. Find product and listing
-                            # 2. Disable the listing
-                            pass
+        return non_magento_listings, inventory_channel_map
+
+    @classmethod
+    def handle_magento_inventory_faults(cls, failed):
+        """
+        Logs the products whose inventory magento refused and disables the
+        listings of the products it reported as missing
+
+        :param failed: List of tuples of channel ID, listing ID, product
+                       identifier and the result of magento for the product
+        """
+        missing = []
+        for channel_id, listing_id, identifier, result in failed:
+            # Dictionary of the fault of the product
+            fault = result if isinstance(result, dict) else {}
+            logger.warning(
+                "Inventory of product %s not exported to "
+                "channel %s: %s %s" % (
+                    identifier, channel_id, fault.get('faultCode'),
+                    fault.get('faultMessage', result)
+                )
+            )
+            if str(fault.get('faultCode')) == str(PRODUCT_NOT_EXISTS_FAULT):
+                missing.append(listing_id)
+
+        if missing:
+            cls.mark_missing_on_magento(cls.browse(missing))
+
+    def get_magento_inventory_data(self):
+        """
+        Returns the inventory data of the listing to send to magento
+        """
+        product_data = {
+            'qty': self.quantity,
+        }
+
+        # TODO: Get this from availability used
+        if self.magento_product_type == 'simple':
+            # Only send inventory for simple products
+            product_data['is_in_stock'] = '1' if self.quantity > 0 else '0'
+        else:
+            # configurable, bundle and everything else
+            product_data['is_in_stock'] = '1'
+        return product_data
+
+    def is_magento_inventory_exported(self, product_data):
+        """
+        Returns True if the inventory data is what was last exported to
+        magento for the listing
+
+        :param product_data: Inventory data, see
+                             `get_magento_inventory_data`
+        """
+        return self.magento_exported_quantity is not None and \
+            self.magento_exported_quantity == product_data['qty'] and \
+            self.magento_exported_in_stock == \
+            (product_data['is_in_stock'] == '1')
+
+    @staticmethod
+    def push_magento_inventory(credentials, listing_data_list, batcher):
+        """
+        Sends the inventory of the listings of a channel to magento in
+        batches, over a session of its own. Runs in a worker thread, so the
+        database is not touched.
+
+        :param credentials: Tuple of magento URL, API user, API key and
+                            timeout of the calls of the channel
+        :param listing_data_list: List of tuples of listing ID and the
+                                  identifier and inventory data of its
+                                  product
+        :param batcher: `AdaptiveBatcher` sizing the batches of the channel
+        :return: Tuple of the list of tuples of listing ID, the data sent
+                 and the result returned by magento for it, and the batch
+                 size the batcher ended up with
+        """
+        manager = SessionManager(*credentials)
+        try:
+            inventory_api = manager.get('Inventory')
+
+            responses = []
+            for listing_data_batch, response in batcher.run(
+                listing_data_list, lambda listing_data_batch: (
+                    inventory_api.update_multi([
+                        listing_data
+                        for _, listing_data in listing_data_batch
+                    ])
+                )
+            ):
+                # Magento bulk API will not raise Faults.
+                # Instead the response contains the faults as a dict
+                for (listing_id, listing_data), result in zip(
+                    listing_data_batch, response
+                ):
+                    responses.append((listing_id, listing_data, result))
+            return responses, batcher.size
+        finally:
+            manager.close()
+
+    @classmethod
+    def set_magento_exported_inventory(cls, exported):
+        """
+        Records the inventory exported to magento on the listings, with a
+        single write grouped by the values exported.
+
+        The write date of the listings moves along, so they are selected
+        again by the next export of the channel, where their unchanged
+        inventory is skipped without calling magento.
+
+        :param exported: Dictionary of tuples of quantity and stock status
+                         to the IDs of the listings exported with them
+        """
+        args = []
+        for (quantity, in_stock), listing_ids in exported.iteritems():
+            args.extend((cls.browse(listing_ids), {
+                'magento_exported_quantity': quantity,
+                'magento_exported_in_stock': in_stock,
+            }))
+        if args:
+            cls.write(*args)
 
 
 class Product:
@@ -365,6 +725,8 @@ class Product:
 
         if not listings:
             Listing.create_from(channel, product_data)
+        else:
+            Listing.relink_using_magento_data(listings, product_data)
 
         return product
 
@@ -415,21 +777,97 @@ class Product:
         # TODO: Remove this method completely and stick to the channel API
         # The method above (create_from) should be used instead.
         Template = Pool().get('product.template')
+
+        product_template, = Template.create([
+            cls.get_template_values_using_magento_data(
+                product_data, cls.get_category_using_magento_data(product_data)
+            )
+        ])
+        return product_template.products[0]
+
+    @classmethod
+    def create_many_using_magento_data(cls, products_data):
+        """
+        Create new products with their listings on the current channel from
+        a batch of product data from magento. The categories of the batch
+        are resolved first, then all the templates are created at once and
+        so are the listings.
+
+        :param products_data: List of product data from magento
+        :returns: List of active records of products created, in the order
+                  of the data
+        """
+        Template = Pool().get('product.template')
+        Listing = Pool().get('product.product.channel_listing')
+        Channel = Pool().get('sale.channel')
+
+        channel = Channel.get_current_magento_channel()
+
+        # Products of the batch share few categories, resolve each once
+        category_ids = [
+            product_data.get('categories') and
+            int(product_data['categories'][0]) or None
+            for product_data in products_data
+        ]
+        categories = {}
+        for category_id, product_data in zip(category_ids, products_data):
+            if category_id not in categories:
+                categories[category_id] = \
+                    cls.get_category_using_magento_data(product_data)
+
+        templates = Template.create([
+            cls.get_template_values_using_magento_data(
+                product_data, categories[category_id]
+            ) for category_id, product_data in zip(category_ids, products_data)
+        ])
+        products = [template.products[0] for template in templates]
+
+        Listing.create([{
+            'channel': channel.id,
+            'product': product.id,
+            # Do not match with SKU. Magento fucks up when there are
+            # numeric SKUs
+            'product_identifier': product_data['product_id'],
+            'magento_product_type': product_data['type'],
+        } for product, product_data in zip(products, products_data)])
+
+        return products
+
+    @classmethod
+    def get_category_using_magento_data(cls, product_data):
+        """
+        Returns the category of the product: the first of its categories on
+        magento. If it has none, or it does not exist on magento, the
+        product goes to the unclassified category which is created by
+        default data
+
+        :param product_data: Product Data from Magento
+        :returns: Active record of category
+        """
         Category = Pool().get('product.category')
+        ModelData = Pool().get('ir.model.data')
 
-        # Get only the first category from the list of categories
-        # If no category is found, put product under unclassified category
-        # which is created by default data
+        category = None
         if product_data.get('categories'):
             category = Category.find_or_create_using_magento_id(
                 int(product_data['categories'][0])
             )
-        else:
-            categories = Category.search([
-                ('name', '=', 'Unclassified Magento Products')
-            ])
-            category = categories[0]
+        if category is None:
+            category = Category(ModelData.get_id(
+                "magento", "product_category_magento_unclassified"
+            ))
+        return category
+
+    @classmethod
+    def get_template_values_using_magento_data(cls, product_data, category):
+        """
+        Returns the values to create the template of a product, with its
+        product, from magento data
 
+        :param product_data: Product Data from Magento
+        :param category: Active record of category of the product
+        :returns: Dictionary of values
+        """
         product_template_values = cls.extract_product_values_from_data(
             product_data
         )
@@ -446,8 +884,7 @@ class Product:
             }])],
             'category': category.id,
         })
-        product_template, = Template.create([product_template_values])
-        return product_template.products[0]
+        return product_template_values
 
     def update_from_magento(self):
         """
@@ -460,10 +897,7 @@ class Product:
 
         channel = Channel.get_current_magento_channel()
 
-        with magento.Product(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as product_api:
+        with channel.magento_session('Product') as product_api:
             channel_listing, = SaleChannelListing.search([
                 ('product', '=', self.id),
                 ('channel', '=', channel.id),
@@ -558,10 +992,7 @@ class Product:
                 'missing_product_code', (self.name,)
             )
 
-        with magento.Product(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as product_api:
+        with channel.magento_session('Product') as product_api:
             # We create only simple products on magento with the default
             # attribute set
             # TODO: We have to call the method from core API extension
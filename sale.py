@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import magento
 from decimal import Decimal
 import xmlrpclib
 from datetime import datetime
@@ -10,6 +9,7 @@ from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval
+from trytond.tools import grouped_slice
 
 
 __all__ = [
@@ -90,6 +90,33 @@ class Sale:
 
         return sales and sales[0] or None
 
+    @classmethod
+    def find_many_using_magento_ids(cls, channel, order_ids):
+        """
+        Finds the sales of the channel with the given magento IDs using a
+        single query (per IN_MAX ids) on the magento_id, channel index
+
+        :param channel: Active record of the channel
+        :param order_ids: List of magento order IDs
+        :return: Dictionary of active records of sales found, keyed by their
+                 magento ID
+        """
+        sale = cls.__table__()
+        cursor = Transaction().cursor
+
+        sales = {}
+        for sub_ids in grouped_slice(order_ids):
+            cursor.execute(*sale.select(
+                sale.magento_id, sale.id,
+                where=(
+                    sale.magento_id.in_(list(sub_ids)) &
+                    (sale.channel == channel.id)
+                )
+            ))
+            for magento_id, sale_id in cursor.fetchall():
+                sales[magento_id] = cls(sale_id)
+        return sales
+
     @classmethod
     def get_sale_using_magento_data(cls, order_data):
         """
@@ -266,23 +293,30 @@ class Sale:
         :param order_data: Order Data from magento
         """
         Bom = Pool().get('production.bom')
+        Channel = Pool().get('sale.channel')
 
-        for item in order_data['items']:
+        channel = Channel.get_current_magento_channel()
+
+        # Resolve the products of all the items at once
+        with channel.magento_products(
+            self.get_skus_using_magento_data(order_data)
+        ):
+            for item in order_data['items']:
 
-            # If the product is a child product of a bundle product, do not
-            # create a separate line for this.
-            if 'bundle_option' in item['product_options'] and \
-                    item['parent_item_id']:
-                continue
+                # If the product is a child product of a bundle product, do
+                # not create a separate line for this.
+                if 'bundle_option' in item['product_options'] and \
+                        item['parent_item_id']:
+                    continue
 
-            sale_line = self.get_sale_line_using_magento_data(item)
-            if sale_line is not None:
-                self.lines.append(sale_line)
+                sale_line = self.get_sale_line_using_magento_data(item)
+                if sale_line is not None:
+                    self.lines.append(sale_line)
 
-        # Handle bundle products.
-        # Find/Create BoMs for bundle products
-        # If no bundle products exist in sale, nothing extra will happen
-        Bom.find_or_create_bom_for_magento_bundle(order_data)
+            # Handle bundle products.
+            # Find/Create BoMs for bundle products
+            # If no bundle products exist in sale, nothing extra will happen
+            Bom.find_or_create_bom_for_magento_bundle(order_data)
 
         if order_data.get('shipping_method'):
             self.lines.append(
@@ -294,6 +328,24 @@ class Sale:
                 self.get_discount_line_data_using_magento_data(order_data)
             )
 
+    @classmethod
+    def get_skus_using_magento_data(cls, order_data):
+        """
+        Returns the SKUs of the products needed to import the order: those
+        of the top level items and of the components of bundles
+
+        :param order_data: Order Data from magento
+        :return: List of SKUs
+        """
+        skus = []
+        for item in order_data['items']:
+            if not item['parent_item_id']:
+                skus.append(item['sku'])
+            elif 'bundle_option' in item['product_options'] and \
+                    item['product_type'] not in ('virtual', 'downloadable'):
+                skus.append(item['sku'])
+        return skus
+
     def get_sale_line_using_magento_data(self, item):
         """
         Get sale.line data from magento data.
@@ -358,10 +410,7 @@ class Sale:
         sale = cls.find_using_magento_increment_id(order_increment_id)
 
         if not sale:
-            with magento.Order(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as order_api:
+            with channel.magento_session('Order') as order_api:
                 order_data = order_api.info(order_increment_id)
 
             sale = cls.create_using_magento_data(order_data)
@@ -500,10 +549,7 @@ class Sale:
         # order status change due to its workflow constraints.
         # TODO: Find a better way to do it
         try:
-            with magento.Order(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as order_api:
+            with channel.magento_session('Order') as order_api:
                 if self.state == 'cancel':
                     order_api.cancel(increment_id)
                 elif self.state == 'done':
@@ -534,10 +580,7 @@ class Sale:
         if order_data is None:
             # XXX: Magento order_data is already there, so need not to
             # fetch again
-            with magento.Order(
-                self.channel.magento_url, self.channel.magento_api_user,
-                self.channel.magento_api_key
-            ) as order_api:
+            with self.channel.magento_session('Order') as order_api:
                 order_data = order_api.info(self.reference)
 
         if order_data['status'] == 'complete':
@@ -616,10 +659,7 @@ class StockShipmentOut:
             code, title = carrier.get_magento_mapping()
 
         # Add tracking info to the shipment on magento
-        with magento.Shipment(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as shipment_api:
+        with channel.magento_session('Shipment') as shipment_api:
             shipment_increment_id = shipment_api.addtrack(
                 self.magento_increment_id, code, title, self.tracking_number
             )
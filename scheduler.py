@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+import time
+import Queue
+import logging
+import threading
+import traceback
+from urlparse import urlparse
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .api import get_active_sessions
+
+logger = logging.getLogger('magento')
+
+#: Database objects inherited by a forked worker process from its parent,
+#: never to be closed, see `init_worker_process`
+_inherited = []
+
+
+class ChannelJob(threading.Thread):
+    """
+    Runs a method of a channel in a worker thread, within a transaction of
+    its own.
+
+    The worker waits for a slot on the semaphore of the magento host of the
+    channel before it starts. A job which runs past its timeout is abandoned
+    by the scheduler: it is no longer waited for and its transaction is
+    rolled back instead of committed. As a thread cannot be stopped, the
+    job keeps its slot until it really ends, so the host is never called by
+    more workers than allowed.
+    """
+
+    def __init__(
+        self, database_name, user, context, channel_id, method_name,
+        semaphore, timeout=None
+    ):
+        super(ChannelJob, self).__init__(
+            name='magento-%s-%s' % (method_name, channel_id)
+        )
+        self.daemon = True
+        self.database_name = database_name
+        self.user = user
+        self.context = context
+        self.channel_id = channel_id
+        self.method_name = method_name
+        self.semaphore = semaphore
+        self.timeout = timeout
+
+        self.started_at = None
+        self.error = None
+        self.timed_out = False
+        self._lock = threading.Lock()
+
+    def run(self):
+        self.semaphore.acquire()
+        self.started_at = time.time()
+        try:
+            self.run_job()
+        except Exception, exc:
+            logger.exception(
+                "Job %s of channel %s failed" % (
+                    self.method_name, self.channel_id
+                )
+            )
+            self.error = exc
+        finally:
+            self.semaphore.release()
+
+    def run_job(self):
+        """
+        Calls the method on the channel and commits its transaction
+        """
+        with Transaction().start(
+            self.database_name, self.user, context=self.context
+        ):
+            Channel = Pool().get('sale.channel')
+
+            try:
+                getattr(Channel(self.channel_id), self.method_name)()
+            except Exception:
+                Transaction().cursor.rollback()
+                raise
+            with self._lock:
+                if self.timed_out:
+                    Transaction().cursor.rollback()
+                else:
+                    Transaction().cursor.commit()
+
+    def has_expired(self):
+        """
+        Returns True if the job has been running longer than its timeout
+        """
+        return bool(
+            self.timeout and self.started_at and
+            time.time() - self.started_at > self.timeout
+        )
+
+    def abandon(self):
+        """
+        Marks the job as timed out, its transaction is rolled back when it
+        ends
+        """
+        with self._lock:
+            self.timed_out = True
+        logger.error(
+            "Job %s of channel %s timed out after %s seconds" % (
+                self.method_name, self.channel_id, self.timeout
+            )
+        )
+
+
+def get_channel_host(channel):
+    """
+    Returns the magento host of the channel
+    """
+    return urlparse(channel.magento_url).netloc.lower()
+
+
+def get_host_semaphores(channels):
+    """
+    Returns a semaphore per magento host of the channels, sized by the
+    lowest `magento_host_concurrency` among the channels of the host
+    """
+    host_limits = {}
+    for channel in channels:
+        host = get_channel_host(channel)
+        limit = max(channel.magento_host_concurrency or 1, 1)
+        host_limits[host] = min(host_limits.get(host, limit), limit)
+    return dict(
+        (host, threading.Semaphore(limit))
+        for host, limit in host_limits.items()
+    )
+
+
+def run_channel_calls(calls, max_workers=8):
+    """
+    Runs a function per channel in a bounded pool of threads, so that the
+    calls to different magento instances overlap while the calls to the
+    same host stay within the `magento_host_concurrency` of its channels.
+
+    The functions run outside of any transaction and must not touch the
+    database: everything they need from the records is to be read
+    beforehand.
+
+    :param calls: List of tuples of an active record of channel and the
+                  function to call without arguments
+    :param max_workers: Maximum number of threads of the pool
+    :return: Dictionary of channel ID to a tuple of the return value of the
+             function and the exception it raised, if any
+    """
+    semaphores = get_host_semaphores([channel for channel, _ in calls])
+
+    queue = Queue.Queue()
+    for channel, function in calls:
+        queue.put(
+            (channel.id, semaphores[get_channel_host(channel)], function)
+        )
+
+    results = {}
+
+    def work():
+        while True:
+            try:
+                channel_id, semaphore, function = queue.get_nowait()
+            except Queue.Empty:
+                return
+            with semaphore:
+                try:
+                    results[channel_id] = (function(), None)
+                except Exception, exc:
+                    logger.exception(
+                        "Call on channel %s failed" % channel_id
+                    )
+                    results[channel_id] = (None, exc)
+
+    workers = [
+        threading.Thread(target=work, name='magento-call-%s' % index)
+        for index in range(min(max(max_workers, 1), len(calls)))
+    ]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return results
+
+
+def run_channel_jobs(channels, method_name, poll_interval=0.5):
+    """
+    Runs the method on each channel in parallel, each in a worker and a
+    transaction of its own, so that a slow store view does not hold up the
+    others.
+
+    Channels on the same magento host share a semaphore sized by the lowest
+    `magento_host_concurrency` among them, and each job is abandoned after
+    the `magento_sync_timeout` of its channel. An abandoned job holds its
+    slot on the host until it ends.
+
+    :param channels: List of active records of magento channels
+    :param method_name: Name of the channel method to run
+    :param poll_interval: Seconds to wait between checks on the workers
+    :return: List of the jobs run
+    """
+    transaction = Transaction()
+
+    semaphores = get_host_semaphores(channels)
+
+    jobs = []
+    for channel in channels:
+        job = ChannelJob(
+            transaction.cursor.database_name, transaction.user,
+            transaction.context.copy(), channel.id, method_name,
+            semaphores[get_channel_host(channel)], channel.magento_sync_timeout
+        )
+        job.start()
+        jobs.append(job)
+
+    while True:
+        running = [
+            running_job for running_job in jobs
+            if running_job.is_alive() and not running_job.timed_out
+        ]
+        if not running:
+            break
+        for running_job in running:
+            if running_job.has_expired():
+                running_job.abandon()
+        running[0].join(poll_interval)
+
+    return jobs
+
+
+def init_worker_process():
+    """
+    Prepares a forked worker process of a product import. The database
+    connections, the transaction and the magento sessions inherited from
+    the parent process are set aside so that the worker opens its own.
+
+    The connections inherited are shared with the parent process: closing
+    them, or letting them be garbage collected, would end the session of
+    the parent on the server. They are kept referenced in `_inherited`
+    instead, for the life of the worker, which exits without finalising
+    them. `Transaction.stop` is not used for the same reason.
+    """
+    Database = backend.get('Database')
+    transaction = Transaction()
+    _inherited.append((
+        getattr(Database, '_databases', None),
+        transaction.database, transaction.cursor,
+    ))
+    if hasattr(Database, '_databases'):
+        Database._databases = {}
+
+    transaction.cursor = None
+    transaction.database = None
+    transaction.close = None
+    transaction.user = None
+    transaction.context = None
+    transaction.create_records = None
+    transaction.delete_records = None
+    transaction.delete = None
+    transaction.timestamp = None
+    get_active_sessions().clear()
+
+
+def import_product_shard(args):
+    """
+    Imports a shard of SKUs in a worker process, within a transaction and
+    a magento session of its own
+
+    :param args: Tuple of database name, user, context, channel ID, list of
+                 SKUs and whether existing products are updated
+    :return: Report of the shard, see `run_product_import_workers`
+    """
+    database_name, user, context, channel_id, skus, update = args
+
+    report = new_import_report()
+    try:
+        with Transaction().start(database_name, user, context=context):
+            Channel = Pool().get('sale.channel')
+
+            channel = Channel(channel_id)
+            try:
+                with channel.magento_sync():
+                    products = channel.get_products_by_skus(
+                        skus, update=update
+                    )
+            except Exception:
+                Transaction().cursor.rollback()
+                raise
+            Transaction().cursor.commit()
+    except Exception:
+        # A failed shard does not stop the run
+        report['failures'].append((skus, traceback.format_exc()))
+        return report
+
+    report['product_ids'] = [product.id for product in products.values()]
+    report['missing_skus'] = [
+        sku for sku in skus if sku and sku.strip() not in products
+    ]
+    return report
+
+
+def new_import_report():
+    """
+    Returns an empty product import report
+    """
+    return {'product_ids': [], 'missing_skus': [], 'failures': []}
+
+
+def merge_import_reports(report, other):
+    """
+    Adds the results and failures of the other report to the report
+    """
+    for key in ('product_ids', 'missing_skus', 'failures'):
+        report[key].extend(other[key])
+    return report
+
+
+def run_product_import_workers(pool, workers, channel, skus, update=False):
+    """
+    Splits the SKUs into a shard per worker and imports the shards in the
+    worker processes of the pool. Each worker commits its shard on its own,
+    so the transaction of the caller does not see the products until it
+    starts over.
+
+    :param pool: `multiprocessing.Pool` initialised with
+                 `init_worker_process`
+    :param workers: Number of processes of the pool
+    :param channel: Active record of channel
+    :param skus: List of SKUs
+    :param update: If True, existing products are updated
+    :return: Report of the import, a dictionary of the IDs of the products
+             imported, the SKUs missing on magento and the failures as
+             tuples of the SKUs of the shard and the error
+    """
+    transaction = Transaction()
+
+    report = new_import_report()
+    shards = filter(None, [skus[index::workers] for index in range(workers)])
+    for shard_report in pool.imap_unordered(import_product_shard, [(
+        transaction.cursor.database_name, transaction.user,
+        transaction.context.copy(), channel.id, shard, update
+    ) for shard in shards]):
+        merge_import_reports(report, shard_report)
+    return report
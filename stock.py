@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+from trytond.pool import Pool, PoolMeta
+from trytond.model import ModelSQL, fields
+from trytond.tools import grouped_slice
+
+__metaclass__ = PoolMeta
+__all__ = ['InventoryQueue', 'Move']
+
+
+class InventoryQueue(ModelSQL):
+    """
+    Listings of magento channels whose inventory may have changed since it
+    was last exported. Entries are added by the stock moves of the products
+    and exported in bulk by a cron, several entries of a listing being sent
+    once.
+    """
+    __name__ = 'magento.inventory_queue'
+
+    listing = fields.Many2One(
+        'product.product.channel_listing', 'Listing', required=True,
+        select=True, ondelete='CASCADE'
+    )
+
+    @classmethod
+    def enqueue_products(cls, product_ids):
+        """
+        Queues the active listings of the products on magento channels.
+        A listing is queued again however many entries it has already,
+        as the export may be reading those, see `export_queued_inventory`.
+
+        :param product_ids: List of IDs of products
+        """
+        Listing = Pool().get('product.product.channel_listing')
+
+        product_ids = list(set(filter(None, product_ids)))
+        if not product_ids:
+            return
+
+        listing_ids = set()
+        for sub_ids in grouped_slice(product_ids):
+            listing_ids.update(map(int, Listing.search([
+                ('product', 'in', list(sub_ids)),
+                ('channel.source', '=', 'magento'),
+                ('state', '=', 'active'),
+            ])))
+        if not listing_ids:
+            return
+
+        cls.create([
+            {'listing': listing_id} for listing_id in sorted(listing_ids)
+        ])
+
+    @classmethod
+    def export_queued_inventory(cls, batch_size=5000):
+        """
+        Exports the inventory of the queued listings to magento in bulk,
+        batch by batch, until the queue is empty. Entries of the same
+        listing are coalesced into one export. Only the entries read are
+        deleted, so a listing queued again during the export is exported
+        once more. The entries of the listings which could not be exported
+        stay in the queue for the next run.
+
+        :param batch_size: Number of entries taken from the queue at once
+        """
+        Listing = Pool().get('product.product.channel_listing')
+
+        # Entries read of the listings not exported yet, by listing
+        kept = {}
+        last_id = 0
+        while True:
+            entries = cls.search([
+                ('id', '>', last_id),
+            ], order=[('id', 'ASC')], limit=batch_size)
+            if not entries:
+                break
+            last_id = entries[-1].id
+
+            entries_by_listing = defaultdict(list)
+            for entry in entries:
+                entries_by_listing[entry.listing.id].append(entry)
+
+            listing_ids = sorted(entries_by_listing)
+            Listing.export_bulk_inventory(Listing.browse(listing_ids))
+
+            # Fresh records, the export updated what was sent
+            pending = set(
+                listing.id for listing in Listing.browse(listing_ids)
+                if listing.state == 'active' and
+                not listing.is_magento_inventory_exported(
+                    listing.get_magento_inventory_data()
+                )
+            )
+            exported = []
+            for listing_id, listing_entries in \
+                    entries_by_listing.iteritems():
+                listing_entries = kept.pop(listing_id, []) + listing_entries
+                if listing_id in pending:
+                    kept[listing_id] = listing_entries
+                else:
+                    exported.extend(listing_entries)
+            cls.delete(exported)
+
+
+class Move:
+    "Stock Move"
+    __name__ = 'stock.move'
+
+    #: Fields of a move whose change may change the inventory of its product
+    _magento_inventory_fields = set([
+        'product', 'quantity', 'uom', 'state', 'from_location',
+        'to_location', 'planned_date', 'effective_date',
+    ])
+
+    @classmethod
+    def create(cls, vlist):
+        InventoryQueue = Pool().get('magento.inventory_queue')
+
+        moves = super(Move, cls).create(vlist)
+        InventoryQueue.enqueue_products([m.product.id for m in moves])
+        return moves
+
+    @classmethod
+    def write(cls, *args):
+        InventoryQueue = Pool().get('magento.inventory_queue')
+
+        product_ids = []
+        actions = iter(args)
+        for moves, values in zip(actions, actions):
+            if cls._magento_inventory_fields.intersection(values):
+                product_ids.extend(m.product.id for m in moves)
+                if values.get('product'):
+                    product_ids.append(values['product'])
+
+        super(Move, cls).write(*args)
+        InventoryQueue.enqueue_products(product_ids)
+
+    @classmethod
+    def delete(cls, moves):
+        InventoryQueue = Pool().get('magento.inventory_queue')
+
+        product_ids = [m.product.id for m in moves]
+        super(Move, cls).delete(moves)
+        InventoryQueue.enqueue_products(product_ids)
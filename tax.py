@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
+from decimal import Decimal
+
 from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.cache import Cache
 
 
 class MagentoTax(ModelSQL, ModelView):
@@ -17,6 +21,10 @@ class MagentoTax(ModelSQL, ModelView):
         "sale.channel.magento.tax.tax_rel", "channel_tax", "tax", "Taxes"
     )
 
+    #: Map of channel IDs to maps of normalised rates to tax IDs, cleared
+    #: whenever magento taxes are changed.
+    _rate_cache = Cache('sale.channel.magento.tax.rate', context=False)
+
     @classmethod
     def __setup__(cls):
         super(MagentoTax, cls).__setup__()
@@ -30,6 +38,70 @@ class MagentoTax(ModelSQL, ModelView):
              'unique_tax_percent_per_channel')
         ]
 
+    @classmethod
+    def create(cls, vlist):
+        cls._rate_cache.clear()
+        return super(MagentoTax, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._rate_cache.clear()
+        super(MagentoTax, cls).write(*args)
+
+    @classmethod
+    def delete(cls, magento_taxes):
+        cls._rate_cache.clear()
+        super(MagentoTax, cls).delete(magento_taxes)
+
+    @classmethod
+    def normalize_rate(cls, rate):
+        """
+        Rounds the rate to the precision of tax_percent, so that rates sent
+        by magento as 0.08250001 match the 0.0825 stored
+
+        :param rate: Tax rate as a Decimal
+        """
+        return Decimal(rate).quantize(
+            Decimal(10) ** -cls.tax_percent.digits[1]
+        )
+
+    @classmethod
+    def get_rate_map(cls, channel):
+        """
+        Returns a map of normalised rates to the IDs of the taxes of the
+        channel. The magento taxes of a channel are read with a single query
+        on the first call and served from the cache after that.
+
+        :param channel: Active record of channel
+        """
+        rate_map = cls._rate_cache.get(channel.id)
+        if rate_map is None:
+            rate_map = dict(
+                (
+                    cls.normalize_rate(magento_tax.tax_percent),
+                    map(int, magento_tax.taxes)
+                ) for magento_tax in cls.search([
+                    ('channel', '=', channel.id),
+                ])
+            )
+            cls._rate_cache.set(channel.id, rate_map)
+        return rate_map
+
+    @classmethod
+    def get_taxes_for_rate(cls, channel, rate):
+        """
+        Returns the taxes of the channel with the given rate
+
+        :param channel: Active record of channel
+        :param rate: Tax rate as a Decimal
+        :return: List of active records of tax
+        """
+        Tax = Pool().get('account.tax')
+
+        return Tax.browse(
+            cls.get_rate_map(channel).get(cls.normalize_rate(rate), [])
+        )
+
 
 class MagentoTaxRelation(ModelSQL):
     "Store View Tax Relation"
@@ -43,3 +115,24 @@ class MagentoTaxRelation(ModelSQL):
         'account.tax', 'Tax', ondelete='RESTRICT',
         select=True, required=True
     )
+
+    @classmethod
+    def create(cls, vlist):
+        MagentoTax = Pool().get('sale.channel.magento.tax')
+
+        MagentoTax._rate_cache.clear()
+        return super(MagentoTaxRelation, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        MagentoTax = Pool().get('sale.channel.magento.tax')
+
+        MagentoTax._rate_cache.clear()
+        super(MagentoTaxRelation, cls).write(*args)
+
+    @classmethod
+    def delete(cls, relations):
+        MagentoTax = Pool().get('sale.channel.magento.tax')
+
+        MagentoTax._rate_cache.clear()
+        super(MagentoTaxRelation, cls).delete(relations)
@@ -3,6 +3,7 @@ import sys
 import os
 
 import unittest
+from mock import patch
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
@@ -101,6 +102,54 @@ class TestCountry(TestBase):
                 None
             )
 
+    def test_0050_lookups_served_from_cache(self):
+        """
+        Tests that countries and states are looked up without a query once
+        loaded, and that changes to them are seen
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            country = self.Country.search_using_magento_code('US')
+            subdivision = self.Subdivision.search_using_magento_region(
+                'florida', country
+            )
+            self.assertEqual(subdivision.name, 'Florida')
+
+            with patch.object(self.Country, 'search') as country_search, \
+                    patch.object(self.Subdivision, 'search') as state_search:
+                self.assertEqual(
+                    self.Country.search_using_magento_code('US'), country
+                )
+                self.assertEqual(
+                    self.Subdivision.search_using_magento_region(
+                        'FLORIDA', country
+                    ),
+                    subdivision
+                )
+                self.assertFalse(country_search.called)
+                self.assertFalse(state_search.called)
+
+            self.Subdivision.write([subdivision], {'name': 'Sunshine'})
+            self.assertIsNone(
+                self.Subdivision.search_using_magento_region(
+                    'Florida', country
+                )
+            )
+            self.assertEqual(
+                self.Subdivision.search_using_magento_region(
+                    'sunshine', country
+                ),
+                subdivision
+            )
+
+            country, = self.Country.create([{
+                'name': 'Atlantis', 'code': 'XA',
+            }])
+            self.assertEqual(
+                self.Country.search_using_magento_code('XA'), country
+            )
+
 
 def suite():
     """
@@ -5,7 +5,9 @@ from decimal import Decimal
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
 
+import socket
 import unittest
+import xmlrpclib
 import magento
 from mock import patch, MagicMock
 
@@ -13,6 +15,10 @@ import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from test_base import TestBase, load_json
 from trytond.transaction import Transaction
+from trytond.modules.magento import scheduler
+from trytond.modules.magento.api import (
+    AdaptiveBatcher, get_timeout_transport
+)
 
 DIR = os.path.abspath(os.path.normpath(
     os.path.join(
@@ -30,6 +36,7 @@ def mock_inventory_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.Inventory)
     handle.update.side_effect = lambda id, data: True
+    handle.update_multi.side_effect = lambda data: [True] * len(data)
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -493,6 +500,846 @@ class TestProduct(TestBase):
                     date.today()
                 )
 
+    def test_0120_import_products_in_ranges(self):
+        """
+        Tests that products are listed in ranges of product IDs, that each
+        range is committed with a checkpoint and that an interrupted import
+        resumes after the checkpoint
+        """
+        Category = POOL.get('product.category')
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+            self.channel1.magento_product_import_chunk_size = 2
+            self.channel1.save()
+
+            with txn.set_context({'current_channel': self.channel1.id}):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            skus = {
+                1: 'VGN-TXN27N-B', 2: 'micronmouse5000',
+                9: 'HTC Touch Diamond',
+            }
+
+            def list_products(filters):
+                id_range = filters['product_id']
+                if id_range['from'] == 9 and list_products.fail:
+                    list_products.fail = False
+                    raise IOError('Connection reset by peer')
+                return [{
+                    'product_id': str(product_id), 'sku': sku,
+                } for product_id, sku in skus.items()
+                    if id_range['from'] <= product_id <= id_range['to']]
+            list_products.fail = True
+
+            product_api = MagicMock(spec=magento.Product)
+            handle = MagicMock(spec=magento.Product)
+            handle.__enter__.return_value = handle
+            handle.list.side_effect = list_products
+            handle.multiCall.side_effect = lambda calls: [
+                load_json('products', args[0]) for method, args in calls
+            ]
+            product_api.return_value = handle
+
+            with patch('magento.Product', product_api, create=True), \
+                    patch.object(self.Channel, 'import_category_tree'), \
+                    patch.object(txn.cursor, 'commit') as commit:
+                self.assertRaises(IOError, self.channel1.import_products)
+
+                channel = self.Channel(self.channel1.id)
+                # Ranges 1-2, 3-4 and 5-8 are done
+                self.assertEqual(channel.magento_product_import_last_id, 8)
+                self.assertEqual(commit.call_count, 3)
+                self.assertEqual(Product.search([], count=True), 2)
+
+                handle.list.reset_mock()
+                products = channel.import_products()
+
+                self.assertEqual(
+                    handle.list.call_args_list[0][0][0],
+                    {'product_id': {'from': 9, 'to': 10}}
+                )
+                # The listing ends after 10 empty ranges in a row
+                self.assertEqual(handle.list.call_count, 11)
+                self.assertEqual(
+                    [product.code for product in products],
+                    ['HTC Touch Diamond']
+                )
+                self.assertEqual(Product.search([], count=True), 3)
+                self.assertIsNone(
+                    self.Channel(
+                        self.channel1.id
+                    ).magento_product_import_last_id
+                )
+
+    def test_0130_import_products_updated_after_last_import(self):
+        """
+        Tests that once products have been imported, only the products
+        updated since the last import are listed, and existing ones are
+        updated
+        """
+        Category = POOL.get('product.category')
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({'current_channel': self.channel1.id}):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            def product_info(sku):
+                product_data = load_json('products', sku)
+                if product_info.renamed:
+                    product_data['name'] = 'Renamed Laptop'
+                return product_data
+            product_info.renamed = False
+
+            product_api = MagicMock(spec=magento.Product)
+            handle = MagicMock(spec=magento.Product)
+            handle.__enter__.return_value = handle
+            handle.list.side_effect = lambda filters: (
+                [{'product_id': '1', 'sku': 'VGN-TXN27N-B'}]
+                if 'updated_at' in filters or
+                filters['product_id']['from'] == 1 else []
+            )
+            handle.multiCall.side_effect = lambda calls: [
+                product_info(args[0]) for method, args in calls
+            ]
+            product_api.return_value = handle
+
+            with patch('magento.Product', product_api, create=True), \
+                    patch.object(self.Channel, 'import_category_tree'), \
+                    patch.object(txn.cursor, 'commit'):
+                self.channel1.import_products()
+
+                channel = self.Channel(self.channel1.id)
+                last_import_time = channel.last_product_import_time
+                self.assertTrue(last_import_time)
+
+                product_info.renamed = True
+                handle.list.reset_mock()
+                products = channel.import_products()
+
+                # Listed from the overlap window before the last import
+                listed_from = last_import_time - relativedelta(
+                    minutes=channel.magento_product_import_overlap
+                )
+                self.assertEqual(channel.magento_product_import_overlap, 10)
+                handle.list.assert_called_once_with({
+                    'updated_at': {
+                        'from': listed_from.strftime('%Y-%m-%d %H:%M:%S'),
+                    },
+                })
+                product, = products
+                self.assertEqual(product.name, 'Renamed Laptop')
+                self.assertEqual(Product.search([], count=True), 1)
+                self.assertTrue(
+                    self.Channel(self.channel1.id).last_product_import_time >=
+                    last_import_time
+                )
+
+    def test_0140_import_products_in_worker_processes(self):
+        """
+        Tests that with several workers the SKUs of each chunk are split in
+        shards handed to the worker pool and that the shard reports are
+        merged
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+            self.channel1.magento_product_import_workers = 2
+            self.channel1.save()
+
+            class FakePool(object):
+                "Runs the tasks in process"
+                def __init__(self, processes, initializer=None):
+                    self.processes = processes
+
+                def imap_unordered(self, func, iterable):
+                    return map(func, iterable)
+
+                def close(self):
+                    pass
+
+                def join(self):
+                    pass
+
+            shards = []
+
+            def import_product_shard(args):
+                skus = args[4]
+                shards.append(skus)
+                if 'micronmouse5000' in skus:
+                    return {
+                        'product_ids': [], 'missing_skus': [],
+                        'failures': [(skus, 'Connection refused')],
+                    }
+                return {
+                    'product_ids': [], 'missing_skus': skus, 'failures': [],
+                }
+
+            product_api = MagicMock(spec=magento.Product)
+            handle = MagicMock(spec=magento.Product)
+            handle.__enter__.return_value = handle
+            handle.list.side_effect = lambda filters: [
+                {'product_id': '1', 'sku': 'VGN-TXN27N-B'},
+                {'product_id': '2', 'sku': 'micronmouse5000'},
+                {'product_id': '3', 'sku': 'HTC Touch Diamond'},
+            ] if filters['product_id']['from'] == 1 else []
+            product_api.return_value = handle
+
+            shard_patch = patch.object(
+                scheduler, 'import_product_shard', import_product_shard
+            )
+            with patch('magento.Product', product_api, create=True), \
+                    patch('multiprocessing.Pool', FakePool), \
+                    shard_patch, \
+                    patch.object(self.Channel, 'import_category_tree'), \
+                    patch.object(self.Channel, 'get_products_by_skus') \
+                    as get_products_by_skus, \
+                    patch.object(txn.cursor, 'commit'):
+                self.channel1.magento_product_import_chunk_size = 10
+                products = self.channel1.import_products()
+
+            self.assertEqual(products, [])
+            self.assertFalse(get_products_by_skus.called)
+            self.assertEqual(sorted(shards), [
+                ['VGN-TXN27N-B', 'HTC Touch Diamond'], ['micronmouse5000'],
+            ])
+
+    def test_0145_import_product_shard_in_worker(self):
+        """
+        Tests that a worker initialised from a process with a transaction
+        open can start its own, and that a failed shard is reported instead
+        of stopping the run
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            # The state a forked worker inherits from the parent
+            state = dict(
+                (name, getattr(txn, name)) for name in (
+                    'cursor', 'database', 'close', 'user', 'context',
+                    'create_records', 'delete_records', 'delete',
+                    'timestamp', 'counter',
+                )
+            )
+            try:
+                scheduler.init_worker_process()
+                self.assertIsNone(Transaction().cursor)
+                # The connections shared with the parent stay referenced
+                self.assertIs(scheduler._inherited[-1][2], state['cursor'])
+                self.assertIsNone(Transaction().user)
+                self.assertIsNone(Transaction().context)
+
+                with patch.object(
+                    self.Channel, 'get_products_by_skus',
+                    side_effect=Exception('Broken shard')
+                ):
+                    report = scheduler.import_product_shard((
+                        DB_NAME, USER, CONTEXT, self.channel1.id,
+                        ['VGN-TXN27N-B'], False
+                    ))
+                self.assertEqual(report['product_ids'], [])
+                (skus, error), = report['failures']
+                self.assertEqual(skus, ['VGN-TXN27N-B'])
+                # The shard started its transaction before failing
+                self.assertIn('Broken shard', error)
+                self.assertIsNone(Transaction().cursor)
+            finally:
+                del scheduler._inherited[:]
+                for name, value in state.items():
+                    setattr(txn, name, value)
+
+    def test_0150_create_many_products_using_magento_data(self):
+        """
+        Tests that a batch of products is created with their listings, with
+        the templates created at once and each category resolved once
+        """
+        Category = POOL.get('product.category')
+        Product = POOL.get('product.product')
+        Template = POOL.get('product.template')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                products_data = [
+                    load_json('products', '17'),
+                    load_json('products', '17-wo-category'),
+                    load_json('products', '135'),
+                ]
+                products_data[1].update({
+                    'sku': 'blackberry-no-category', 'product_id': '1017',
+                })
+
+                create = Template.create
+                with patch.object(
+                    Template, 'create', side_effect=create
+                ) as template_create, patch.object(
+                    Category, 'find_or_create_using_magento_id',
+                    side_effect=Category.find_or_create_using_magento_id
+                ) as find_category:
+                    products = Product.create_many_using_magento_data(
+                        products_data
+                    )
+
+                self.assertEqual(template_create.call_count, 1)
+                self.assertEqual(find_category.call_count, 2)
+                self.assertEqual(
+                    [product.code for product in products],
+                    [product_data['sku'] for product_data in products_data]
+                )
+                self.assertEqual(
+                    products[1].category.name, 'Unclassified Magento Products'
+                )
+                listings = Listing.search([
+                    ('channel', '=', self.channel1.id),
+                ], order=[('product_identifier', 'ASC')])
+                self.assertEqual(
+                    sorted(listing.product.id for listing in listings),
+                    sorted(product.id for product in products)
+                )
+                self.assertEqual(
+                    set(listing.magento_product_type for listing in listings),
+                    set(data['type'] for data in products_data)
+                )
+
+    def test_0160_import_category_tree_by_level(self):
+        """
+        Tests that the category tree is created with one create per level
+        and that importing it again creates nothing
+        """
+        Category = POOL.get('product.category')
+        MagentoCategory = POOL.get('magento.instance.product_category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            category_tree = load_json('categories', 'category_tree')
+            with txn.set_context({'current_channel': self.channel1.id}):
+                create = Category.create
+                with patch.object(
+                    Category, 'create', side_effect=create
+                ) as category_create:
+                    Category.create_tree_using_magento_data(category_tree)
+
+                # The tree has 5 levels
+                self.assertEqual(category_create.call_count, 5)
+                self.assertEqual(MagentoCategory.search([
+                    ('channel', '=', self.channel1.id),
+                ], count=True), 27)
+
+                category = Category.find_using_magento_id(8)
+                self.assertEqual(
+                    category.parent.magento_ids[0].magento_id, 13
+                )
+
+                with patch.object(Category, 'create') as category_create, \
+                        patch.object(MagentoCategory, 'search') as search:
+                    Category.create_tree_using_magento_data(category_tree)
+
+                self.assertFalse(category_create.called)
+                self.assertFalse(search.called)
+
+    def test_0170_sync_renamed_and_moved_categories(self):
+        """
+        Tests that importing the category tree again updates categories
+        renamed or moved on magento with a single write
+        """
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            category_tree = load_json('categories', 'category_tree')
+            with txn.set_context({'current_channel': self.channel1.id}):
+                Category.create_tree_using_magento_data(category_tree)
+                categories_before_sync = Category.search([], count=True)
+
+                # Move "Cell Phones" from "Electronics" to "Furniture",
+                # rename it and rename "Household Items"
+                root_catalog, = category_tree['children']
+                furniture, electronics, apparel, household = \
+                    root_catalog['children']
+                cell_phones = electronics['children'].pop(0)
+                cell_phones['name'] = 'Mobile Phones'
+                furniture['children'].append(cell_phones)
+                household['name'] = 'Home'
+
+                write = Category.write
+                with patch.object(
+                    Category, 'write', side_effect=write
+                ) as category_write:
+                    Category.create_tree_using_magento_data(category_tree)
+
+                self.assertEqual(category_write.call_count, 1)
+                self.assertEqual(
+                    Category.search([], count=True), categories_before_sync
+                )
+
+                category = Category.find_using_magento_id(8)
+                self.assertEqual(category.name, 'Mobile Phones')
+                self.assertEqual(category.parent.name, 'Furniture')
+                self.assertEqual(
+                    Category.find_using_magento_id(20).name, 'Home'
+                )
+                self.assertEqual(
+                    Category.find_using_magento_id(12).parent.name,
+                    'Electronics'
+                )
+
+                with patch.object(Category, 'write') as category_write:
+                    Category.create_tree_using_magento_data(category_tree)
+                self.assertFalse(category_write.called)
+
+    def test_0180_memoise_categories_by_magento_id(self):
+        """
+        Tests that categories found by magento ID, and those missing on
+        magento, are looked up once per transaction
+        """
+        Category = POOL.get('product.category')
+        MagentoCategory = POOL.get('magento.instance.product_category')
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults()
+
+            with txn.set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_tree_using_magento_data(
+                    load_json('categories', 'category_tree')
+                )
+                category = Category.find_or_create_using_magento_id(8)
+
+                category_api = MagicMock(spec=magento.Category)
+                handle = MagicMock(spec=magento.Category)
+                handle.__enter__.return_value = handle
+                handle.info.side_effect = xmlrpclib.Fault(
+                    102, 'Category not exists.'
+                )
+                category_api.return_value = handle
+
+                with patch.object(MagentoCategory, 'search') as search, \
+                        patch('magento.Category', category_api, create=True):
+                    self.assertEqual(
+                        Category.find_or_create_using_magento_id(8), category
+                    )
+                    self.assertFalse(search.called)
+
+                    search.return_value = []
+                    self.assertIsNone(
+                        Category.find_or_create_using_magento_id(999)
+                    )
+                    self.assertIsNone(
+                        Category.find_or_create_using_magento_id(999)
+                    )
+                    self.assertEqual(search.call_count, 1)
+                    self.assertEqual(handle.info.call_count, 1)
+
+                    # Products of a missing category are unclassified
+                    product_data = load_json('products', '17')
+                    product_data['categories'] = ['999']
+                    product = Product.create_using_magento_data(product_data)
+                    self.assertEqual(
+                        product.category.name, 'Unclassified Magento Products'
+                    )
+                    self.assertEqual(handle.info.call_count, 1)
+
+                # Within a sync run, the memo is kept by the run across the
+                # commits of the run
+                with self.channel1.magento_sync():
+                    memo = Category.get_magento_id_memo()
+                    memo[(self.channel1.id, 999)] = None
+                    # What a commit does to the transaction cache
+                    txn.cursor.cache.clear()
+                    self.assertIs(Category.get_magento_id_memo(), memo)
+                self.assertIsNot(Category.get_magento_id_memo(), memo)
+
+                # The memo is dropped with the transaction cache
+                txn.cursor.rollback()
+                self.assertFalse(Category.get_magento_id_memo())
+
+    def test_0190_export_changed_inventory_only(self):
+        """
+        Tests that the inventory of a listing is exported again only once
+        it differs from what was last exported
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                Product.find_or_create_using_magento_data(
+                    load_json('products', '135')
+                )
+                listing, = Listing.search([
+                    ('channel', '=', self.channel1.id),
+                ])
+
+                inventory_api = mock_inventory_api()
+                handle = inventory_api.return_value
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory([listing])
+                    handle.update_multi.assert_called_once_with([
+                        [listing.product_identifier, {
+                            'qty': 0, 'is_in_stock': '1',
+                        }],
+                    ])
+
+                    listing = Listing(listing.id)
+                    self.assertEqual(listing.magento_exported_quantity, 0)
+                    self.assertTrue(listing.magento_exported_in_stock)
+
+                    # Nothing changed, nothing is sent
+                    handle.update_multi.reset_mock()
+                    Listing.export_bulk_inventory([listing])
+                    self.assertFalse(handle.update_multi.called)
+
+                    Listing.write([listing], {
+                        'magento_exported_quantity': 5,
+                    })
+                    Listing.export_bulk_inventory([Listing(listing.id)])
+                    self.assertEqual(handle.update_multi.call_count, 1)
+
+    def test_0200_adaptive_inventory_batches(self):
+        """
+        Tests that the batches grow while the calls are quick, shrink when
+        they time out or fail on the server, and that the tuned size of the
+        inventory batches is kept on the channel
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+
+        batcher = AdaptiveBatcher(4, 5)
+        batches = [
+            items for items, _ in batcher.run(range(20), lambda items: True)
+        ]
+        self.assertEqual(map(len, batches), [4, 6, 9, 1])
+        self.assertEqual(sum(batches, []), range(20))
+        self.assertEqual(batcher.size, 13)
+
+        def call(items):
+            if len(items) > 5:
+                raise socket.timeout('timed out')
+            if len(items) > 3:
+                raise xmlrpclib.ProtocolError('', 503, 'Unavailable', {})
+            return True
+
+        batcher = AdaptiveBatcher(8, 5)
+        batches = [items for items, _ in batcher.run(range(7), call)]
+        self.assertEqual(map(len, batches), [2, 3, 2])
+        self.assertEqual(sum(batches, []), range(7))
+
+        # Client errors are not a matter of batch size
+        def call(items):
+            raise xmlrpclib.ProtocolError('', 404, 'Not Found', {})
+
+        with self.assertRaises(xmlrpclib.ProtocolError):
+            list(AdaptiveBatcher(8, 5).run(range(7), call))
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.Channel.write([self.channel1], {
+                'magento_inventory_batch_size': 1,
+            })
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                Product.find_or_create_using_magento_data(
+                    load_json('products', '135')
+                )
+                listings = Listing.search([
+                    ('channel', '=', self.channel1.id),
+                ])
+
+                inventory_api = mock_inventory_api()
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory(listings)
+
+                # The calls give up after the call timeout of the channel
+                transport = inventory_api.call_args[1]['transport']
+                self.assertEqual(
+                    transport.timeout, self.channel1.magento_call_timeout
+                )
+
+            # The tuned size is kept apart from the configured one
+            channel = self.Channel(self.channel1.id)
+            self.assertEqual(channel.magento_inventory_tuned_batch_size, 2)
+            self.assertEqual(channel.magento_inventory_batch_size, 1)
+
+            # Configuring another size starts the tuning over
+            self.Channel.write([channel], {
+                'magento_inventory_batch_size': 20,
+            })
+            channel = self.Channel(self.channel1.id)
+            self.assertIsNone(channel.magento_inventory_tuned_batch_size)
+
+    def test_0205_inventory_push_timeout(self):
+        """
+        Tests that calls to a magento server which does not answer time out
+        and that the inventory push then retries with smaller batches
+        """
+        Listing = POOL.get('product.product.channel_listing')
+
+        # A server which accepts connections but never answers
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        try:
+            proxy = xmlrpclib.ServerProxy(
+                'http://127.0.0.1:%s/' % server.getsockname()[1],
+                transport=get_timeout_transport('http://127.0.0.1/', 0.2)
+            )
+            with self.assertRaises(socket.timeout):
+                proxy.login('user', 'key')
+        finally:
+            server.close()
+
+        inventory_api = mock_inventory_api()
+        handle = inventory_api.return_value
+
+        def update_multi(data):
+            if len(data) > 1:
+                raise socket.timeout('timed out')
+            return [True] * len(data)
+        handle.update_multi.side_effect = update_multi
+
+        listing_data_list = [
+            (listing_id, [str(listing_id), {'qty': 1, 'is_in_stock': '1'}])
+            for listing_id in range(3)
+        ]
+        with patch('magento.Inventory', inventory_api, create=True):
+            responses, batch_size = Listing.push_magento_inventory(
+                ('http://shop.example.com/', 'user', 'key', 30),
+                listing_data_list, AdaptiveBatcher(4, 5)
+            )
+
+        self.assertEqual(
+            [(listing_id, result) for listing_id, _, result in responses],
+            [(0, True), (1, True), (2, True)]
+        )
+        # Halved down to single products, the batch grows again after each
+        # full one until it times out
+        self.assertEqual(batch_size, 2)
+        self.assertEqual(
+            map(len, [c[0][0] for c in handle.update_multi.call_args_list]),
+            [3, 2, 1, 2, 1, 1]
+        )
+
+    def test_0210_disable_listings_missing_on_magento(self):
+        """
+        Tests that a listing whose product is reported missing by magento
+        is disabled and left out of the inventory exports until the product
+        is imported again
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                product_data = load_json('products', '135')
+                Product.find_or_create_using_magento_data(product_data)
+                listing, = Listing.search([
+                    ('channel', '=', self.channel1.id),
+                ])
+
+                inventory_api = mock_inventory_api()
+                handle = inventory_api.return_value
+                handle.update_multi.side_effect = lambda data: [{
+                    'faultCode': '101',
+                    'faultMessage': 'Product not exists.',
+                } for _ in data]
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory([listing])
+
+                    listing = Listing(listing.id)
+                    self.assertEqual(listing.state, 'disabled')
+                    self.assertTrue(listing.magento_missing_since)
+                    self.assertIsNone(listing.magento_exported_quantity)
+
+                    handle.update_multi.reset_mock()
+                    Listing.export_bulk_inventory([listing])
+                    self.assertFalse(handle.update_multi.called)
+
+                # The product is back on magento under a new ID
+                product_data['product_id'] = '1135'
+                Product.find_or_create_using_magento_data(product_data)
+
+                listing = Listing(listing.id)
+                self.assertEqual(listing.state, 'active')
+                self.assertEqual(listing.product_identifier, '1135')
+                self.assertIsNone(listing.magento_missing_since)
+
+    def test_0220_export_bulk_inventory_by_source(self):
+        """
+        Tests that the listings of other channels are handed over to the
+        default export while the magento listings are sent to magento
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                Product.find_or_create_using_magento_data(
+                    load_json('products', '135')
+                )
+                magento_listing, = Listing.search([
+                    ('channel', '=', self.channel1.id),
+                ])
+                # Listing of a channel of another source
+                other_listing = MagicMock()
+                other_listing.channel.id = -1
+                other_listing.channel.source = 'manual'
+
+                inventory_api = mock_inventory_api()
+                handle = inventory_api.return_value
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory(
+                        [other_listing, magento_listing]
+                    )
+
+                other_listing.export_inventory.assert_called_once_with()
+                handle.update_multi.assert_called_once_with([
+                    [magento_listing.product_identifier, {
+                        'qty': 0, 'is_in_stock': '1',
+                    }],
+                ])
+
+    def test_0230_export_queued_inventory(self):
+        """
+        Tests that stock moves queue the listings of their product and that
+        the queue is exported in bulk, a listing once however many times it
+        is queued
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+        Move = POOL.get('stock.move')
+        InventoryQueue = POOL.get('magento.inventory_queue')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                product = Product.find_or_create_using_magento_data(
+                    load_json('products', '135')
+                )
+                listing, = Listing.search([
+                    ('channel', '=', self.channel1.id),
+                ])
+                self.assertFalse(InventoryQueue.search([]))
+
+                supplier, = self.Location.search([('type', '=', 'supplier')])
+                moves = Move.create([{
+                    'product': product.id,
+                    'uom': product.default_uom.id,
+                    'quantity': quantity,
+                    'from_location': supplier.id,
+                    'to_location': self.warehouse.storage_location.id,
+                    'company': self.company.id,
+                    'unit_price': Decimal('1'),
+                    'currency': self.company.currency.id,
+                } for quantity in (5, 3)])
+                Move.write(moves, {'quantity': 4})
+
+                entries = InventoryQueue.search([])
+                self.assertEqual(len(entries), 2)
+                self.assertEqual(
+                    set(entry.listing for entry in entries), set([listing])
+                )
+
+                inventory_api = mock_inventory_api()
+                handle = inventory_api.return_value
+                with patch('magento.Inventory', inventory_api, create=True):
+                    InventoryQueue.export_queued_inventory()
+
+                    self.assertEqual(handle.update_multi.call_count, 1)
+                    self.assertFalse(InventoryQueue.search([]))
+
+                    # A move made while the queue is exported is exported
+                    # after it
+                    Move.write(moves, {'quantity': 3})
+                    export_bulk_inventory = Listing.export_bulk_inventory
+                    moved = []
+
+                    def export_and_move(listings):
+                        export_bulk_inventory(listings)
+                        if not moved:
+                            moved.append(True)
+                            Move.write(moves, {'quantity': 1})
+
+                    with patch.object(
+                        Listing, 'export_bulk_inventory',
+                        side_effect=export_and_move
+                    ):
+                        InventoryQueue.export_queued_inventory()
+
+                    self.assertEqual(handle.update_multi.call_count, 3)
+                    self.assertFalse(InventoryQueue.search([]))
+                    listing = Listing(listing.id)
+                    self.assertTrue(listing.is_magento_inventory_exported(
+                        listing.get_magento_inventory_data()
+                    ))
+
+                    # Entries of listings which failed to export are kept
+                    Move.write(moves, {'quantity': 2})
+                    handle.update_multi.side_effect = lambda data: [{
+                        'faultCode': '1', 'faultMessage': 'Internal Error',
+                    } for _ in data]
+                    InventoryQueue.export_queued_inventory()
+                    self.assertEqual(len(InventoryQueue.search([])), 1)
+
 
 def suite():
     """Test Suite"""
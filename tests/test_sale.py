@@ -3,8 +3,12 @@ import sys
 import os
 from decimal import Decimal
 
+import time
 import unittest
+import threading
+import xmlrpclib
 from datetime import datetime
+from functools import partial
 import pytz
 from dateutil.relativedelta import relativedelta
 
@@ -14,6 +18,9 @@ import trytond.tests.test_tryton
 from trytond.transaction import Transaction
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from test_base import TestBase, load_json
+from trytond.modules.magento.scheduler import (
+    ChannelJob, run_channel_jobs, run_channel_calls
+)
 
 DIR = os.path.abspath(os.path.normpath(
     os.path.join(
@@ -32,6 +39,9 @@ def mock_product_api(mock=None, data=None):
     handle = MagicMock(spec=magento.Product)
     handle.info.side_effect = \
         lambda sku, identifierType: load_json('products', sku)
+    handle.multiCall.side_effect = lambda calls: [
+        load_json('products', args[0]) for method, args in calls
+    ]
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -89,6 +99,7 @@ def mock_tier_price_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.ProductTierPrice)
     handle.update.side_effect = lambda *args, **kwargs: 'Prices Exported'
+    handle.multiCall.side_effect = lambda calls: [True] * len(calls)
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -1448,6 +1459,691 @@ class TestSale(TestBase):
                     m_sale.sale_date, utc_sale_time
                 )
 
+    def test_0150_reuse_magento_session_in_sync_run(self):
+        """
+        Tests that the magento session is opened once for a sync run and
+        closed when the run ends
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            order_api = mock_order_api()
+            with patch('magento.Order', order_api, create=True):
+                with self.channel1.magento_sync():
+                    with self.channel1.magento_session('Order'):
+                        pass
+                    # A fresh active record of the same channel shares the
+                    # session of the run
+                    channel = self.Channel(self.channel1.id)
+                    with channel.magento_session('Order'):
+                        pass
+
+                    self.assertEqual(order_api.call_count, 1)
+                    self.assertFalse(
+                        order_api.return_value.__exit__.called
+                    )
+                self.assertEqual(
+                    order_api.return_value.__exit__.call_count, 1
+                )
+
+                # Outside a sync run every session is closed at the end of
+                # its own block
+                with self.channel1.magento_session('Order'):
+                    pass
+                self.assertEqual(order_api.call_count, 2)
+                self.assertEqual(
+                    order_api.return_value.__exit__.call_count, 2
+                )
+
+    def test_0160_import_orders_using_info_multi(self):
+        """
+        Tests that orders are imported page by page, fetched in batches using
+        info_multi and that already imported orders are not fetched again
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+            self.channel1.magento_order_batch_size = 1
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            order_api = mock_order_api()
+            handle = order_api.return_value
+            pages = [{
+                'hasNext': True,
+                'items': [{'order_id': '1', 'increment_id': '100000001'}],
+            }, {
+                'hasNext': False,
+                'items': [{'order_id': '4', 'increment_id': '100000004'}],
+            }]
+            handle.search.side_effect = \
+                lambda filters, limit, page: pages[page - 1]
+            handle.info_multi.side_effect = lambda increment_ids: [
+                load_json('orders', increment_id)
+                for increment_id in increment_ids
+            ]
+
+            customer_api = mock_customer_api()
+            product_api = mock_product_api()
+            cursor = Transaction().cursor
+            with Transaction().set_context(company=self.company), \
+                    patch('magento.Order', order_api, create=True), \
+                    patch('magento.Customer', customer_api, create=True), \
+                    patch('magento.Product', product_api, create=True), \
+                    patch.object(cursor, 'commit') as commit:
+                sales = self.channel1.import_orders()
+
+                self.assertEqual(len(sales), 2)
+                self.assertEqual(Sale.search([], count=True), 2)
+                self.assertEqual(handle.info_multi.call_count, 2)
+                self.assertFalse(handle.info.called)
+                # The start of the run, each chunk of orders and each page
+                # are committed on their own
+                self.assertEqual(commit.call_count, 5)
+
+                sales_by_id = Sale.find_many_using_magento_ids(
+                    self.channel1, [1, 4, 5]
+                )
+                self.assertEqual(set(sales_by_id.keys()), set([1, 4]))
+                self.assertEqual(
+                    set(sales_by_id.values()), set(Sale.search([]))
+                )
+                self.assertEqual(
+                    Sale.find_many_using_magento_ids(self.channel2, [1, 4]),
+                    {}
+                )
+
+                # Orders are already imported, nothing is fetched again
+                sales = self.channel1.import_orders()
+
+                self.assertEqual(len(sales), 2)
+                self.assertEqual(Sale.search([], count=True), 2)
+                self.assertEqual(handle.info_multi.call_count, 2)
+
+    def test_0170_import_orders_updated_after_last_import(self):
+        """
+        Tests that only orders updated after the last import time (less the
+        overlap window) are listed and that the last import time advances to
+        the latest order processed, recording the orders magento failed to
+        send
+        """
+        ChannelException = POOL.get('channel.exception')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+            self.channel1.last_order_import_time = datetime(2013, 6, 1)
+            self.channel1.magento_order_import_overlap = 10
+            self.channel1.save()
+
+            order_api = mock_order_api()
+            handle = order_api.return_value
+            handle.search.return_value = {
+                'hasNext': False,
+                'items': [{
+                    'order_id': '1', 'increment_id': '100000001',
+                    'updated_at': '2013-06-29 05:53:09',
+                }],
+            }
+            handle.info_multi.side_effect = lambda increment_ids: [
+                {'isFault': True, 'faultCode': '100',
+                    'faultMessage': 'Requested order not exists.'}
+                for increment_id in increment_ids
+            ]
+
+            cursor = Transaction().cursor
+            with patch('magento.Order', order_api, create=True), \
+                    patch.object(cursor, 'commit'):
+                self.channel1.import_orders()
+
+            filters = handle.search.call_args[1]['filters']
+            self.assertEqual(
+                filters['updated_at'], {'gt': '2013-05-31 23:50:00'}
+            )
+            self.assertEqual(
+                self.Channel(self.channel1.id).last_order_import_time,
+                datetime(2013, 6, 29, 5, 53, 9)
+            )
+            # The order magento failed to send is on record
+            exception, = ChannelException.search([
+                ('channel', '=', self.channel1.id),
+            ])
+            self.assertIn('100000001', exception.log)
+            self.assertIn('Requested order not exists.', exception.log)
+
+            # Nothing new on magento, the last import time stays
+            handle.search.return_value = {'hasNext': False, 'items': []}
+            with patch('magento.Order', order_api, create=True), \
+                    patch.object(cursor, 'commit'):
+                self.channel1.import_orders()
+
+            self.assertEqual(
+                self.Channel(self.channel1.id).last_order_import_time,
+                datetime(2013, 6, 29, 5, 53, 9)
+            )
+
+    def test_0180_resume_interrupted_order_import(self):
+        """
+        Tests that an order import which fails midway keeps a checkpoint of
+        the pages done without moving the last import time, and that the
+        next run resumes after the checkpoint
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+            self.channel1.last_order_import_time = datetime(2013, 6, 1)
+            self.channel1.save()
+
+            pages = [{
+                'hasNext': True,
+                'items': [{
+                    'order_id': '1', 'increment_id': '100000001',
+                    'updated_at': '2013-06-02 10:00:00',
+                }],
+            }, {
+                'hasNext': False,
+                'items': [{
+                    'order_id': '2', 'increment_id': '100000002',
+                    'updated_at': '2013-06-03 10:00:00',
+                }],
+            }]
+
+            def search(filters, limit, page):
+                if page == 2 and not search.available:
+                    raise xmlrpclib.ProtocolError('', 502, 'Bad Gateway', {})
+                return pages[page - 1]
+            search.available = False
+
+            order_api = mock_order_api()
+            handle = order_api.return_value
+            handle.search.side_effect = search
+            handle.info_multi.side_effect = lambda increment_ids: [
+                {'isFault': True, 'faultCode': '100',
+                    'faultMessage': 'Requested order not exists.'}
+                for increment_id in increment_ids
+            ]
+
+            cursor = Transaction().cursor
+            with patch('magento.Order', order_api, create=True), \
+                    patch.object(cursor, 'commit'):
+                self.assertRaises(
+                    xmlrpclib.ProtocolError, self.channel1.import_orders
+                )
+
+            channel = self.Channel(self.channel1.id)
+            self.assertTrue(channel.magento_order_import_run)
+            self.assertEqual(channel.magento_order_import_page, 1)
+            self.assertEqual(
+                channel.magento_order_import_increment_id, '100000001'
+            )
+            self.assertEqual(
+                channel.magento_order_import_updated_at,
+                datetime(2013, 6, 2, 10, 0, 0)
+            )
+            self.assertEqual(
+                channel.last_order_import_time, datetime(2013, 6, 1)
+            )
+
+            search.available = True
+            handle.search.reset_mock()
+            with patch('magento.Order', order_api, create=True), \
+                    patch.object(cursor, 'commit'):
+                channel.import_orders()
+
+            self.assertEqual(handle.search.call_count, 1)
+            self.assertEqual(handle.search.call_args[1]['page'], 2)
+
+            channel = self.Channel(self.channel1.id)
+            self.assertIsNone(channel.magento_order_import_run)
+            self.assertIsNone(channel.magento_order_import_page)
+            self.assertEqual(
+                channel.last_order_import_time,
+                datetime(2013, 6, 3, 10, 0, 0)
+            )
+
+    def test_0190_run_cron_jobs_in_parallel(self):
+        """
+        Tests that the cron jobs run each channel in a worker of its own,
+        within the concurrency limit of the magento host, and that a job
+        past its timeout is abandoned
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.Channel.write([self.channel1], {
+                'magento_url': 'http://shop.example.com/en/',
+                'magento_host_concurrency': 1,
+            })
+            self.Channel.write([self.channel2], {
+                'magento_url': 'http://shop.example.com/fr/',
+                'magento_host_concurrency': 1,
+            })
+
+            lock = threading.Lock()
+            calls = []
+            running = []
+
+            def run_job(job):
+                with lock:
+                    running.append(job.channel_id)
+                    calls.append((job.channel_id, len(running)))
+                time.sleep(0.2)
+                with lock:
+                    running.remove(job.channel_id)
+
+            with patch.object(ChannelJob, 'run_job', run_job):
+                self.Channel.export_order_status_to_magento_using_cron()
+
+            self.assertEqual(
+                sorted(channel_id for channel_id, _ in calls),
+                sorted([self.channel1.id, self.channel2.id])
+            )
+            # Both channels are on the same host, one at a time
+            self.assertEqual(max(count for _, count in calls), 1)
+
+            self.Channel.write([self.channel1], {'magento_sync_timeout': 1})
+            self.Channel.write([self.channel2], {
+                'magento_url': 'http://other.example.com/',
+            })
+            stuck = threading.Event()
+
+            def run_slow_job(job):
+                if job.channel_id == self.channel1.id:
+                    stuck.wait(10)
+
+            with patch.object(ChannelJob, 'run_job', run_slow_job):
+                started = time.time()
+                jobs = run_channel_jobs(
+                    self.Channel.browse([self.channel1.id, self.channel2.id]),
+                    'export_shipment_status_to_magento', poll_interval=0.1
+                )
+                self.assertLess(time.time() - started, 5)
+
+                timed_out = dict((job.channel_id, job) for job in jobs)
+                self.assertTrue(timed_out[self.channel1.id].timed_out)
+                self.assertFalse(timed_out[self.channel2.id].timed_out)
+
+                # The abandoned job holds its slot on the host until it ends
+                abandoned = timed_out[self.channel1.id]
+                self.assertFalse(abandoned.semaphore.acquire(False))
+                stuck.set()
+                abandoned.join(5)
+                self.assertTrue(abandoned.semaphore.acquire(False))
+
+    def test_0200_skip_failing_order_on_import(self):
+        """
+        Tests that orders are committed in chunks and that an order which
+        fails to import is recorded as a channel exception and skipped
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+        ChannelException = POOL.get('channel.exception')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+            self.channel1.magento_order_commit_size = 2
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            order_api = mock_order_api()
+            handle = order_api.return_value
+            handle.search.return_value = {
+                'hasNext': False,
+                'items': [
+                    {'order_id': '1', 'increment_id': '100000001'},
+                    {'order_id': '4', 'increment_id': '100000004'},
+                ],
+            }
+            handle.info_multi.side_effect = lambda increment_ids: [
+                load_json('orders', increment_id)
+                for increment_id in increment_ids
+            ]
+
+            create_using_magento_data = Sale.create_using_magento_data
+
+            def create_sale(order_data):
+                if order_data['increment_id'] == '100000001':
+                    raise Exception('Broken order')
+                return create_using_magento_data(order_data)
+
+            customer_api = mock_customer_api()
+            product_api = mock_product_api()
+            create_patch = patch.object(
+                Sale, 'create_using_magento_data', side_effect=create_sale
+            )
+            cursor = Transaction().cursor
+            with Transaction().set_context(company=self.company), \
+                    patch('magento.Order', order_api, create=True), \
+                    patch('magento.Customer', customer_api, create=True), \
+                    patch('magento.Product', product_api, create=True), \
+                    create_patch, \
+                    patch.object(cursor, 'commit'), \
+                    patch.object(cursor, 'rollback') as rollback:
+                sales = self.channel1.import_orders()
+
+            self.assertEqual(len(sales), 1)
+            self.assertEqual(sales[0].magento_id, 4)
+            self.assertEqual(rollback.call_count, 1)
+
+            exception, = ChannelException.search([
+                ('channel', '=', self.channel1.id),
+            ])
+            self.assertIn('100000001', exception.log)
+            self.assertIn('Broken order', exception.log)
+
+    def test_0210_get_taxes_using_rate_map(self):
+        """
+        Tests that taxes are found by rate through the rate map, with rates
+        rounded to the precision of tax percent, and that the map follows
+        changes to the magento taxes
+        """
+        Tax = POOL.get('account.tax')
+        MagentoTax = POOL.get('sale.channel.magento.tax')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            tax1, tax2 = Tax.create([{
+                'name': 'Sales Tax %s' % index,
+                'description': 'Sales Tax %s' % index,
+                'type': 'none',
+                'company': self.company.id,
+            } for index in (1, 2)])
+            magento_tax, = MagentoTax.create([{
+                'channel': self.channel1.id,
+                'tax_percent': Decimal('0.0825'),
+                'taxes': [('add', [tax1.id])],
+            }])
+
+            self.assertEqual(
+                self.channel1.get_taxes(Decimal('0.0825')), [tax1]
+            )
+            self.assertEqual(
+                self.channel1.get_taxes(Decimal('0.08250001')), [tax1]
+            )
+            self.assertEqual(self.channel1.get_taxes(Decimal('0.07')), [])
+            self.assertEqual(self.channel2.get_taxes(Decimal('0.0825')), [])
+
+            with patch.object(MagentoTax, 'search') as search:
+                self.channel1.get_taxes(Decimal('0.0825'))
+                self.assertFalse(search.called)
+
+            MagentoTax.write([magento_tax], {
+                'taxes': [('add', [tax2.id])],
+            })
+            self.assertEqual(
+                set(self.channel1.get_taxes(Decimal('0.0825'))),
+                set([tax1, tax2])
+            )
+
+    def test_0220_get_products_by_skus(self):
+        """
+        Tests that products are resolved in bulk, fetching from magento
+        only the SKUs which have no product or listing yet
+        """
+        Product = POOL.get('product.product')
+        Listing = POOL.get('product.product.channel_listing')
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            product_api = mock_product_api()
+            handle = product_api.return_value
+
+            def multi_call(calls):
+                return [
+                    load_json('products', args[0]) if args[0] != 'missing'
+                    else {'isFault': True, 'faultCode': 101,
+                          'faultMessage': 'Product not exists.'}
+                    for method, args in calls
+                ]
+            handle.multiCall.side_effect = multi_call
+
+            with patch('magento.Product', product_api, create=True):
+                products = self.channel1.get_products_by_skus([
+                    'VGN-TXN27N-B', 'VGN-TXN27N-B ', 'missing',
+                ])
+
+                self.assertEqual(products.keys(), ['VGN-TXN27N-B'])
+                self.assertEqual(
+                    products['VGN-TXN27N-B'].code, 'VGN-TXN27N-B'
+                )
+                self.assertEqual(handle.multiCall.call_count, 1)
+                self.assertEqual(
+                    sorted(
+                        args[0] for method, args in
+                        handle.multiCall.call_args[0][0]
+                    ),
+                    ['VGN-TXN27N-B', 'missing']
+                )
+                self.assertEqual(Listing.search([
+                    ('channel', '=', self.channel1.id),
+                ], count=True), 1)
+
+                # Known SKUs are resolved without a call to magento
+                handle.multiCall.reset_mock()
+                products = self.channel1.get_products_by_skus([
+                    'VGN-TXN27N-B',
+                ])
+                self.assertFalse(handle.multiCall.called)
+                self.assertEqual(products['VGN-TXN27N-B'].code, 'VGN-TXN27N-B')
+
+                # The product exists but has no listing on this channel
+                products = self.channel2.get_products_by_skus([
+                    'VGN-TXN27N-B',
+                ])
+                self.assertEqual(handle.multiCall.call_count, 1)
+                self.assertEqual(
+                    Product.search([
+                        ('code', '=', 'VGN-TXN27N-B'),
+                    ], count=True), 1
+                )
+                self.assertEqual(Listing.search([
+                    ('channel', '=', self.channel2.id),
+                ], count=True), 1)
+
+    def test_0230_run_channel_calls(self):
+        """
+        Tests that the calls of the channels overlap within the concurrency
+        limit of their host and a failing call does not stop the others
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.Channel.write([self.channel1], {
+                'magento_url': 'http://shop.example.com/en/',
+                'magento_host_concurrency': 1,
+            })
+            self.Channel.write([self.channel2], {
+                'magento_url': 'http://shop.example.com/fr/',
+                'magento_host_concurrency': 1,
+            })
+            channel3, = self.Channel.copy([self.channel1], {
+                'magento_url': 'http://other.example.com/',
+            })
+
+            lock = threading.Lock()
+            running = []
+            overlaps = []
+
+            def call(channel_id):
+                with lock:
+                    running.append(channel_id)
+                    overlaps.append(list(running))
+                time.sleep(0.2)
+                with lock:
+                    running.remove(channel_id)
+                if channel_id == channel3.id:
+                    raise xmlrpclib.Fault(1, 'Internal Error')
+                return channel_id
+
+            results = run_channel_calls([
+                (channel, partial(call, channel.id))
+                for channel in [self.channel1, self.channel2, channel3]
+            ])
+
+            self.assertEqual(
+                results[self.channel1.id], (self.channel1.id, None)
+            )
+            self.assertEqual(
+                results[self.channel2.id], (self.channel2.id, None)
+            )
+            self.assertIsNone(results[channel3.id][0])
+            self.assertIsInstance(results[channel3.id][1], xmlrpclib.Fault)
+
+            # Channels of the same host never ran together
+            for channel_ids in overlaps:
+                self.assertFalse(
+                    self.channel1.id in channel_ids and
+                    self.channel2.id in channel_ids
+                )
+            # The other host was not held up
+            self.assertTrue(
+                any(channel3.id in ids and len(ids) > 1 for ids in overlaps)
+            )
+
+    def test_0240_export_tier_prices_in_multicalls(self):
+        """
+        Tests that tier prices are exported in multicalls, that the
+        listings of products missing on magento are disabled and that the
+        prices refused otherwise are sent again by the next export
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+        MagentoPriceTier = POOL.get('sale.channel.magento.price_tier')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_tree_using_magento_data(
+                    load_json('categories', 'category_tree')
+                )
+                for sku in ('135', '164'):
+                    Product.find_or_create_using_magento_data(
+                        load_json('products', sku)
+                    )
+                listing1, listing2 = Listing.search([
+                    ('channel', '=', self.channel1.id),
+                ], order=[('id', 'ASC')])
+
+                MagentoPriceTier.create([{
+                    'channel': self.channel1.id,
+                    'quantity': 10,
+                }])
+
+                tier_price_api = mock_tier_price_api()
+                handle = tier_price_api.return_value
+                handle.multiCall.side_effect = lambda calls: [True, {
+                    'isFault': True,
+                    'faultCode': '101',
+                    'faultMessage': 'Product not exists.',
+                }]
+                with patch(
+                    'magento.ProductTierPrice', tier_price_api, create=True
+                ):
+                    self.assertEqual(
+                        self.channel1.export_product_prices(batch_size=2), 2
+                    )
+
+                calls, = handle.multiCall.call_args[0]
+                self.assertEqual(
+                    [call[1][0] for call in calls], [
+                        listing1.product_identifier,
+                        listing2.product_identifier,
+                    ]
+                )
+                self.assertEqual(calls[0][1][1][0]['qty'], 10)
+                self.assertEqual(handle.multiCall.call_count, 1)
+                self.assertFalse(handle.update.called)
+
+                self.assertEqual(Listing(listing1.id).state, 'active')
+                self.assertEqual(Listing(listing2.id).state, 'disabled')
+                last_export_time = self.channel1.last_product_price_export_time
+                self.assertTrue(last_export_time)
+
+                handle.multiCall.side_effect = lambda calls: [{
+                    'isFault': True,
+                    'faultCode': '1',
+                    'faultMessage': 'Internal Error',
+                }]
+                Product.write([listing1.product], {'code': 'new-code'})
+                with patch(
+                    'magento.ProductTierPrice', tier_price_api, create=True
+                ):
+                    self.assertEqual(
+                        self.channel1.export_product_prices(batch_size=2), 1
+                    )
+
+                self.assertEqual(Listing(listing1.id).state, 'active')
+                self.assertEqual(
+                    self.Channel(
+                        self.channel1.id
+                    ).last_product_price_export_time,
+                    last_export_time
+                )
+
+    def test_0250_import_orders_without_commit_size(self):
+        """
+        Tests that channels saved before the order commit size existed
+        commit orders in chunks of the default size
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            channel_table = self.Channel.__table__()
+            Transaction().cursor.execute(*channel_table.update([
+                channel_table.magento_order_batch_size,
+                channel_table.magento_order_commit_size,
+            ], [1, None], where=channel_table.id == self.channel1.id))
+            channel = self.Channel(self.channel1.id)
+            self.assertIsNone(channel.magento_order_commit_size)
+
+            order_api = mock_order_api()
+            handle = order_api.return_value
+            handle.info_multi.side_effect = lambda increment_ids: [
+                {'increment_id': increment_id}
+                for increment_id in increment_ids
+            ]
+            create_patch = patch.object(
+                self.Channel, 'create_magento_orders', return_value=[]
+            )
+            with patch('magento.Order', order_api, create=True), \
+                    create_patch as create_magento_orders:
+                channel.import_orders_using_magento_summaries([
+                    {'order_id': '1', 'increment_id': '100000001'},
+                    {'order_id': '4', 'increment_id': '100000004'},
+                ])
+
+            self.assertEqual(handle.info_multi.call_count, 2)
+            # Both batches make a single chunk
+            create_magento_orders.assert_called_once_with([
+                {'increment_id': '100000001'},
+                {'increment_id': '100000004'},
+            ])
+
 
 def suite():
     """
@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import magento
 import json
 from .api import Core
 
@@ -245,10 +244,7 @@ class ConfigureMagento(Wizard):
         """
         magento_channel = self.start.channel
 
-        with Core(
-            magento_channel.magento_url, magento_channel.magento_api_user,
-            magento_channel.magento_api_key
-        ) as core_api:
+        with magento_channel.magento_session(Core) as core_api:
             websites = core_api.websites()
 
         selection = []
@@ -273,10 +269,7 @@ class ConfigureMagento(Wizard):
 
         selected_website = json.loads(self.import_website.magento_websites)
 
-        with Core(
-            magento_channel.magento_url, magento_channel.magento_api_user,
-            magento_channel.magento_api_key
-        ) as core_api:
+        with magento_channel.magento_session(Core) as core_api:
             stores = core_api.stores(selected_website['id'])
 
         all_stores = []
@@ -407,7 +400,8 @@ class UpdateMagentoCatalog(Wizard):
             ('channel', '=', self),
             ('state', '=', 'active'),
         ])
-        with Transaction().set_context({'current_channel': channel.id}):
+        with Transaction().set_context({'current_channel': channel.id}), \
+                channel.magento_sync():
             for listing in channel_listings:
                 products.append(
                     listing.product.update_from_magento()
@@ -448,9 +442,8 @@ class ExportDataWizardConfigure(ModelView):
         channel = Channel(Transaction().context['active_id'])
         channel.validate_magento_channel()
 
-        with magento.ProductAttributeSet(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
+        with channel.magento_session(
+            'ProductAttributeSet'
         ) as attribute_set_api:
             attribute_sets = attribute_set_api.list()
 